@@ -9,123 +9,433 @@
 #
 
 import traceback
+import logging
+import selectors
 import socket
+import threading
+import time
 import json
-import zlib
-import pickle
-def b2i(b):
-    return int.from_bytes(b, 'little')
-def i2b(i):
-    return int(i).to_bytes(4,"little")
-debug = 0
-# head 0: image, 1: send_cameras, 2: don't send cameras
+from collections import deque
+import numpy as np
+from protocol import b2i, i2b, FRAME_HEADER, BATCH_HEADER, VIEWPORT, unpack_viewport_ids, pack_camera_batch, CODEC_NONE, CODEC_SHM, FLAG_DELTA, FLAG_KEYFRAME, FLAG_DEPTH, \
+    parse_frame_header, decode_frame, decode_payload, BufferPool, LatestMailbox, IncrementalReader, take
+from shm_transport import ShmRing, SHM_OFFER
+from delta import DeltaDecoder
+from quality import QUALITY_REPORT, QUALITY_ECHO, unpack_report
+from profiling import timer
+log = logging.getLogger(__name__)
+# head 1: image, 2: send_cameras, 3: don't send cameras, 4: don't read, 5: shared memory offer, 6: quality report
+# we send head 0: camera, 1: shared memory answer, 2: keyframe request, 3: quality report echo, 4: camera batch
+class RendererStream():
+    """One connected renderer: its socket, what we know about it and the parser of what it sends."""
+    def __init__(self, stream_id, conn, addr, pool, max_in_flight=2):
+        self.id = stream_id
+        self.conn = conn
+        self.addr = addr
+        self.pool = pool
+        self.can_send = False
+        self.can_read = True
+        self.camera_requested = True # the renderer needs the current camera even if it did not change
+        self.sent_seq = 0 # newest camera sent to this renderer
+        self.viewport_seqs = {} # viewport id -> seq of the last camera of that viewport sent to it
+        self._send_lock = threading.Lock() # the receiver thread echoes, the GUI thread sends cameras
+        self._shm = None # shared memory ring offered by a renderer on this host
+        self._delta = DeltaDecoder() # canvases delta frames are patched into
+        self._keyframe_requested = False
+        self.quality = None # last quality report of an adaptive renderer
+        # pipelining: at most max_in_flight cameras wait for their images at a time
+        self.max_in_flight = max_in_flight
+        self.in_flight_timeout = 1.0 # a renderer that skipped a camera never answers it
+        self._in_flight = deque() # (seq, sent at)
+        self.newest_answered = 0 # newest camera seq an image batch came back for
+        self.frames_discarded = 0
+        self.messages = deque() # parsed, not yet returned by RemoteRenderer.read()
+        self.reader = IncrementalReader(self._parse())
+
+    def close(self):
+        self.conn.close()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def send(self, data):
+        with self._send_lock:
+            self.conn.sendall(data)
+
+    def _parse(self):
+        while True:
+            head = b2i((yield from take(4)))
+            log.debug("stream %d head %d", self.id, head)
+            ret_dic = {"status":1, "stream":self.id}
+            if head==1:
+                self.can_read = True
+                ret_dic['image'], ret_dic['batch'] = yield from self._read_image()
+            elif head==2:
+                self.can_send = True
+                self.camera_requested = True
+                ret_dic['send'] = True
+            elif head==3:
+                self.can_send = False
+                ret_dic['send'] = False
+            elif head==4:
+                self.can_read = False
+            elif head==5:
+                self._accept_shm((yield from take(SHM_OFFER.size)))
+            elif head==6:
+                self.quality = unpack_report((yield from take(QUALITY_REPORT.size)))
+                # echo right away, the renderer measures the round trip
+                self.send(i2b(3)+QUALITY_ECHO.pack(self.quality["timestamp"]))
+                ret_dic['quality'] = self.quality
+            else:
+                raise ConnectionError(f"unknown message {head}")
+            self.messages.append(ret_dic)
+
+    def _read_image(self):
+        nums, camera_seq, camera_time, sent_time, num_viewports = BATCH_HEADER.unpack((yield from take(BATCH_HEADER.size)))
+        viewports = unpack_viewport_ids((yield from take(num_viewports * VIEWPORT.size))) if num_viewports else None
+        # frames rendered for a camera older than one we already got an answer for are stale
+        batch = {"camera_seq": camera_seq, "camera_time": camera_time, "sent_time": sent_time,
+                 "superseded": 0 < camera_seq < self.newest_answered, "depth": {}, # window -> depth
+                 "viewports": viewports} # window -> viewport it shows, None: all show viewport 0
+        self.newest_answered = max(self.newest_answered, camera_seq)
+        images_attr = []
+        for _ in range(nums):
+            info = parse_frame_header((yield from take(FRAME_HEADER.size)))
+            window = len(images_attr) # depth frames are not windows
+            if info["flags"] & FLAG_DEPTH:
+                depth = yield from take(info["payload_nbytes"])
+                if images_attr: # a copy, it outlives the frame it belongs to
+                    batch["depth"][window - 1] = decode_frame(info, depth).astype(np.float32)
+                continue
+            if info["codec"] == CODEC_SHM:
+                ref = yield from take(info["payload_nbytes"])
+                with timer.stage("shm copy"):
+                    images_attr.append(self._read_shm_image(info, ref))
+                continue
+            begin = time.perf_counter()
+            data_bytes = yield from take(info["payload_nbytes"], self.pool)
+            if timer.enabled: # from asking for the payload to having all of it
+                timer.record("recv", begin, time.perf_counter())
+            with timer.stage("decode"):
+                if info["flags"] & FLAG_DELTA:
+                    images_attr.append(self._read_delta_image(window, info, data_bytes))
+                    self.pool.release(data_bytes)
+                    continue
+                image = decode_frame(info, data_bytes)
+                if info["flags"] & FLAG_KEYFRAME:
+                    self._delta.keyframe(window, image)
+                    self._keyframe_requested = False
+            images_attr.append(image)
+            if info["codec"] != CODEC_NONE: # uncompressed frames are views of the pooled buffer
+                self.pool.release(data_bytes)
+        return images_attr, batch
+
+    def _read_delta_image(self, window_id, info, data_bytes):
+        raw = decode_payload(info, data_bytes)
+        out = self.pool.acquire(int(np.prod(info["shape"])) * info["dtype"].itemsize)
+        image = np.frombuffer(out, dtype=info["dtype"]).reshape(info["shape"])
+        if self._delta.decode(window_id, info, raw, image):
+            return image
+        self.pool.release(out)
+        if not self._keyframe_requested: # we missed the keyframe this delta is based on
+            self._keyframe_requested = True
+            self.send(i2b(2))
+        return None
+
+    def _accept_shm(self, offer):
+        if self._shm is not None:
+            self._shm.close()
+        self._shm = ShmRing.attach(offer)
+        print(f"stream {self.id}: shared memory transport", "on" if self._shm is not None else "refused, not on the same host")
+        self.send(i2b(1)+i2b(self._shm is not None))
+
+    def _read_shm_image(self, info, ref):
+        # one memcpy out of the ring, so the renderer can reuse the slot while we display the frame
+        if self._shm is None:
+            return None
+        out = self.pool.acquire(info["raw_nbytes"])
+        if not self._shm.read_into(ref, out):
+            self.pool.release(out) # overwritten before we got to it, skip this frame
+            return None
+        return decode_frame(dict(info, codec=CODEC_NONE), out)
+
+    def can_request_camera(self):
+        # False while max_in_flight cameras are still waiting for their images
+        now = time.monotonic()
+        while self._in_flight and (self._in_flight[0][0] <= self.newest_answered
+                                   or now - self._in_flight[0][1] > self.in_flight_timeout):
+            self._in_flight.popleft()
+        return self.camera_requested or len(self._in_flight) < self.max_in_flight
+
+    def send_camera(self, message_bytes, seq=0):
+        # message_bytes: protocol.pack_camera(seq, ...), returns whether it was sent
+        if not self._send_camera(i2b(0)+message_bytes, seq): # 0: camera
+            return False
+        self.viewport_seqs = {0: seq}
+        return True
+
+    def send_camera_batch(self, num_viewports, cameras, seq=0):
+        # cameras: [(viewport id, protocol.pack_camera(seq, ...))] of the viewports that changed
+        if not self._send_camera(i2b(4)+pack_camera_batch(num_viewports, cameras), seq): # 4: camera batch
+            return False
+        self.viewport_seqs = {v: s for v, s in self.viewport_seqs.items() if v < num_viewports}
+        self.viewport_seqs.update((viewport, seq) for viewport, _ in cameras)
+        return True
+
+    def _send_camera(self, data, seq):
+        if not self.can_send:
+            return False
+        try:
+            log.debug("stream %d: send camera %d", self.id, seq)
+            self.send(data)
+        except OSError as e:
+            print(e) # the receiver thread notices the broken connection and drops the stream
+            return False
+        self.camera_requested = False
+        self.sent_seq = seq
+        self._in_flight.append((seq, time.monotonic()))
+        return True
+
 class RemoteRenderer():
-    def __init__(self):
+    """Listens for renderers, any number of them, and reads all of them from one thread.
+
+    Every connection is a stream with its own id. read() returns the messages of
+    all streams in the order they completed; a renderer sending large frames only
+    gets one recv at a time, so it can't keep the others waiting.
+    """
+    def __init__(self, max_in_flight=2, host="0.0.0.0", port=12345):
+        self.host = host
+        self.port = port # 0 picks a free port, see socker.getsockname()
+        self.max_in_flight = max_in_flight
         self.socker = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.begin_listen()
-        self.conn = None
-        self.addr = None
-        self.can_send = False
-        self.can_read = True
-    def reset(self):
-        if self.conn!=None:
-            self.conn.close()
-        self.conn = None
+        self.pool = BufferPool(max_per_size=8)
+        self.streams = {} # stream id -> RendererStream
+        self._next_id = 0
+        self._lock = threading.RLock() # read() runs on the receiver thread, the GUI looks at the streams
+        self._messages = deque()
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.socker, selectors.EVENT_READ)
+        # wake() interrupts a select, for stop and for streams that resume reading
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._paused = set() # ids of streams we stopped reading after a single batch
     def begin_listen(self):
         try:
-
-            host = "0.0.0.0"
-            port = 12345
-            self.socker.bind((host, port))
+            # a restarted viewer can listen again while the old connection is in TIME_WAIT
+            self.socker.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socker.bind((self.host, self.port))
             self.socker.listen()
             self.socker.settimeout(0)
         except Exception as e:
             print(e)
             traceback.print_exc()
-    def _get_a_renderer(self):
-        if self.conn==None:
-            try:
-                self.conn, self.addr = self.socker.accept()
-                print(f"\nConnected by {self.addr}")
-                self.conn.settimeout(None)
-                return True
-            except Exception as inst:
-                self.reset()
-                return False
-        else:
-            return True
-    def read(self):
-        has_con = self._get_a_renderer()
-        if has_con:
-            try:
-                conn = self.conn
-                head = conn.recv(4) # may stuck
-                head = int.from_bytes(head,"little")
-                if head==0:
-                    self.reset()
-                print(head)
-                ret_dic = {"status":1}
-                if head==1:
-                    self.can_read = True
-                    print("read image")
-                    ret_dic['image']= self.read_image()#{"image":self.read_image()}
-                elif head==2:
-                    self.can_send = True
-                    ret_dic['send'] = True
-                elif head==3:
-                    self.can_send = False
-                    ret_dic['send'] = False
-                elif head==4:
-                    self.can_read = False
-                return ret_dic
-            except Exception as e:
-                print(e)
-                self.reset()
-                return {"status":0}
-        else:
-            return {"status": 0}
-    def read_image(self):
-        # message = self.read()
-        nums = b2i(self.conn.recv(4))
-        images_attr = []
-        for i in range(nums):
-            size = self.conn.recv(12)
-            message_length, width,height = b2i(size[:4]),b2i(size[4:8]),b2i(size[8:12])
-            print(message_length,width,height)
-            #message_length = width*height*3
-            data_bytes = self.read_buffer(message_length)
-            img_str = zlib.decompress(data_bytes)
-            img_arr = pickle.loads(img_str)
-            import numpy as np
-            #img_arr = np.frombuffer(data_bytes,dtype=np.uint8)
-            img_arr = img_arr.reshape((width,height,3))
-            images_attr.append(img_arr)
-        return images_attr
-
-    def read_buffer(self,messageLength):
-        img_arr_bytes = b''
-        while len(img_arr_bytes) < messageLength:
-            chunk = self.conn.recv(messageLength - len(img_arr_bytes))
-            if not chunk:
+
+    def stream_list(self):
+        with self._lock:
+            return [self.streams[i] for i in sorted(self.streams)]
+
+    def _accept(self):
+        try:
+            conn, addr = self.socker.accept()
+        except OSError:
+            return
+        conn.setblocking(True) # readiness comes from the selector, one recv per event never blocks
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # cameras go out right away, not after a delayed ACK
+        with self._lock:
+            stream = RendererStream(self._next_id, conn, addr, self.pool, self.max_in_flight)
+            self.streams[stream.id] = stream
+            self._next_id += 1
+        self._selector.register(conn, selectors.EVENT_READ, stream)
+        print(f"\nConnected by {addr}, stream {stream.id}")
+
+    def _drop(self, stream):
+        with self._lock:
+            if self.streams.pop(stream.id, None) is None:
+                return
+            self._paused.discard(stream.id)
+        try:
+            self._selector.unregister(stream.conn)
+        except (KeyError, ValueError):
+            pass
+        stream.close()
+        self._messages.append({"status":1, "stream":stream.id, "closed":True})
+        print(f"stream {stream.id} ({stream.addr}) disconnected")
+
+    def _poll(self, timeout):
+        # one select round, returns True if wake() interrupted it
+        woken = False
+        for stream in self.stream_list():
+            if stream.id in self._paused and stream.can_read: # "read remote" was clicked
+                self._paused.discard(stream.id)
+                self._selector.register(stream.conn, selectors.EVENT_READ, stream)
+        for key, _ in self._selector.select(timeout):
+            if key.fileobj is self.socker:
+                self._accept()
+            elif key.fileobj is self._wake_r:
+                woken = True
+                try:
+                    while self._wake_r.recv(64):
+                        pass
+                except BlockingIOError:
+                    pass
+            else:
+                stream = key.data
+                try:
+                    alive = stream.reader.feed(stream.conn)
+                except Exception as e:
+                    print(f"stream {stream.id}:", e)
+                    alive = False
+                self._messages.extend(stream.messages)
+                stream.messages.clear()
+                if not alive:
+                    self._drop(stream)
+                elif not stream.can_read: # it sent a single batch, leave the rest in the socket
+                    self._selector.unregister(stream.conn)
+                    self._paused.add(stream.id)
+        return woken
+
+    def read(self, timeout=None):
+        """Returns the next message of any stream, {"status": 0} if none arrived within timeout.
+        Call it from one thread only, the FrameReceiver's. wake() makes it return early."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._messages:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
                 break
-            img_arr_bytes += chunk
-        return img_arr_bytes
-
-    def send_cameras(self,message_bytes):
-        has_con = self._get_a_renderer()
-        global debug
-        if has_con and self.can_send:
-            try:
-                print("send",debug,self.can_send)
-                debug+=1
-                conn = self.conn
-                conn.sendall(i2b(0)) # 0: camera
-                conn.sendall(len(message_bytes).to_bytes(4, 'little'))
-                conn.sendall(message_bytes)
-            except Exception as e:
-                self.reset()
-                print(e)
-
-        else:
+            if self._poll(remaining):
+                break
+        if self._messages:
+            return self._messages.popleft()
+        return {"status": 0}
+
+    def wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
             pass
 
+    def resume_reading(self):
+        for stream in self.stream_list():
+            stream.can_read = True
+        self.wake()
+
+    def recycle(self, images):
+        # call once the images returned by read() are uploaded and no longer used
+        for image in images:
+            self.pool.release_array(image)
+
+    def send_cameras(self, message_bytes, seq=0, stream_ids=None):
+        # sends to every stream that wants cameras, or to stream_ids only; returns the ids it went to
+        sent = []
+        for stream in self.stream_list():
+            if (stream_ids is None or stream.id in stream_ids) and stream.send_camera(message_bytes, seq):
+                sent.append(stream.id)
+        return sent
+
+    def reset(self):
+        # disconnects every renderer, they reconnect on their own
+        for stream in self.stream_list():
+            self._drop(stream)
+
+    def close(self):
+        self.reset()
+        self._selector.close()
+        self.socker.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+
+
+class FrameReceiver():
+    """Runs RemoteRenderer.read() on its own thread so the GUI never waits on the network.
+
+    Every window of every stream has a one-frame mailbox: the thread decodes into
+    pooled buffers and publishes, the GUI thread takes the newest completed frame
+    and uploads it. A frame replaced before it was taken goes straight back to the
+    pool, so do frames rendered for a camera that was already superseded.
+    """
+    def __init__(self, remote_renderer, on_message=None):
+        self.remote_renderer = remote_renderer
+        self.on_message = on_message # called on the receiver thread after every message, e.g. to wake the GUI
+        self.slots = {} # (stream id, window id) -> LatestMailbox
+        self.closed_streams = [] # ids of disconnected streams, see take_closed()
+        self._slots_lock = threading.Lock()
+        self._stop = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop = True
+        self.remote_renderer.wake()
+        self._thread.join(1.0)
+        self.remote_renderer.reset()
+
+    def wake(self):
+        self.remote_renderer.wake()
+
+    def _slot(self, key):
+        with self._slots_lock:
+            if key not in self.slots:
+                self.slots[key] = LatestMailbox(1)
+            return self.slots[key]
+
+    def _loop(self):
+        remote_renderer = self.remote_renderer
+        while not self._stop:
+            remote_info = remote_renderer.read(timeout=0.5)
+            if remote_info["status"] == 0:
+                continue
+            self._handle(remote_info)
+            if self.on_message is not None:
+                self.on_message()
+
+    def _handle(self, remote_info):
+        remote_renderer = self.remote_renderer
+        if remote_info.get("closed"):
+            self._close_stream(remote_info["stream"])
+            return
+        if "image" not in remote_info:
+            return
+        stream = remote_renderer.streams.get(remote_info["stream"])
+        batch = remote_info["batch"]
+        if batch["superseded"]:
+            if stream is not None:
+                stream.frames_discarded += 1
+            remote_renderer.recycle(image for image in remote_info["image"] if image is not None)
+            return
+        for i, image in enumerate(remote_info["image"]):
+            if image is None: # lost shared memory frame
+                continue
+            dropped = self._slot((remote_info["stream"], i)).put((image, batch))
+            if dropped is not None:
+                remote_renderer.recycle([dropped[0]])
+
+    def _close_stream(self, stream_id):
+        # its windows are gone, frames still waiting in them go back to the pool
+        with self._slots_lock:
+            slots = [self.slots.pop(key) for key in [key for key in self.slots if key[0] == stream_id]]
+            self.closed_streams.append(stream_id)
+        for slot in slots:
+            self.remote_renderer.recycle(image for image, _ in slot.drain())
+
+    def take_closed(self):
+        """Returns the ids of the streams that disconnected since the last call."""
+        with self._slots_lock:
+            closed, self.closed_streams = self.closed_streams, []
+        return closed
+
+    def take_latest(self):
+        """Returns {(stream id, window id): (newest image, its batch info)} for the windows that got a new frame."""
+        with self._slots_lock:
+            slots = sorted(self.slots.items())
+        frames = {}
+        for key, slot in slots:
+            pending = slot.drain()
+            if pending:
+                self.remote_renderer.recycle(image for image, _ in pending[:-1])
+                frames[key] = pending[-1]
+        return frames
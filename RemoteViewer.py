@@ -9,35 +9,119 @@
 # For inquiries contact  george.drettakis@inria.fr
 #
 
-import torch
 import traceback
+import logging
+import errno
+import os
 import socket
+import select
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import json
-import pickle
-from m_scripts.camera_utils import GS_Cam
-import zlib
-def b2i(b):
-    return int.from_bytes(b, 'little')
-def i2b(i):
-    return int(i).to_bytes(4,"little")
-# Peer: head 0: image, 1: send_cameras, 2: don't send cameras
-# head 0: camera
+import numpy as np
+from protocol import b2i, i2b, encode_frame, codec_id, BufferPool, LatestMailbox, recv_into_exact, recv_exact, \
+    CAMERA_MESSAGE, WINDOW_SIZE, BATCH_HEADER, CAMERA_BATCH, VIEWPORT, CODEC_NONE, CODEC_SHM, FLAG_DEPTH, unpack_camera, \
+    unpack_window_sizes, pack_viewport_ids, send_buffers, frame_header
+from shm_transport import ShmRing
+from delta import DeltaEncoder
+from quality import QualityController, QUALITY_ECHO, apply_quality
+from profiling import timer
+from tensor_frames import TensorStager, is_tensor, to_depth_array
+from recording import Recorder
+log = logging.getLogger(__name__)
+# Peer: head 1: image, 2: send_cameras, 3: don't send cameras, 4: don't receive, 5: shared memory offer,
+#       6: quality report
+# head 0: camera, 1: shared memory answer, 2: keyframe request, 3: quality report echo, 4: camera batch
 class RemoteViewer():
-    def __init__(self,host,port):
+    def __init__(self,host,port,codec="zlib",async_send=False,mailbox_size=1,device="cuda",encode_workers=None,
+                 transport="tcp",shm_slots=8,shm_slot_bytes=8 << 20,
+                 delta=False,tile_size=32,delta_threshold=0,keyframe_interval=120,
+                 adaptive=False,target_fps=30,latency_budget=None,
+                 connect_timeout=1.0,max_backoff=5.0,record=None):
         self.host = host
         self.port = port
+        self.socker = None
+        self.device = device # where camera matrices returned by read() live
+        self.camera = None # newest camera received, the viewer only sends it again when it changes
+        self.camera_seq = 0
+        self.camera_time = 0.0 # viewer timestamp of that camera, echoed with the images rendered from it
+        self.resolution = None # (height, width) the viewer wants rendered, None if it has no preference
+        self.window_sizes = [] # (width, height) of the viewer's image windows
+        # several viewports: viewport id -> (camera message, camera), viewport 0 is the one above
+        self.viewport_cameras = {}
+        self.viewports = [] # their ids
+        self.cameras = [] # cameras of all viewports, in viewport order
+        self.camera_batch = None # the same cameras stacked, see _stack_cameras
+        self._num_viewports = 1
+        self.codec = codec_id(codec) # none, zlib (level 1) or any codec added with protocol.register_codec
         self.recieve_camera = False
         self.contiunous_mode = False
-        self.peer_status = {"image":1,"send":2,"dont send":3,"dont receive":4}
+        self.peer_status = {"image":1,"send":2,"dont send":3,"dont receive":4,"shm":5,"quality":6}
         self.connect_success = False
+        self.pool = BufferPool()
+        self._lock = threading.RLock() # guards connect/reset, the sender thread may reset too
+        self._send_lock = threading.Lock() # one writer on the socket at a time
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        # images of a batch are compressed in parallel, zlib and lz4 release the GIL
+        self.encode_workers = encode_workers or min(8, os.cpu_count() or 1)
+        self._encoder = None
+        self._new_cameras = None # viewport id -> newest camera message not returned by read() yet
+        # transport="shm": offer a shared memory ring on connect, the viewer takes it if it runs on this host
+        if transport not in ("tcp", "shm"):
+            raise ValueError(f"unknown transport {transport!r}")
+        self.transport = transport
+        self.shm_slots = shm_slots
+        self.shm_slot_bytes = shm_slot_bytes
+        self._shm = None
+        self._shm_ready = False
+        # delta=True: only send the tiles that changed since the previous frame of each window
+        self._delta = DeltaEncoder(tile_size, delta_threshold, keyframe_interval) if delta else None
+        # adaptive=True: codec, level, quantization and downscale follow the measured link
+        self.quality = QualityController(target_fps, latency_budget) if adaptive else None
+        self._last_report = 0.0
+        self._stager = None # pinned host buffers for torch tensor frames, created on the first one
+        # record="run.rvr": every batch also goes to a recording, whether a viewer is connected or not
+        self._recorder = Recorder(record) if record is not None else None
+        self._camera_message = None # CAMERA_MESSAGE bytes of viewport 0's camera, stored with the records
+        # async mode: send_images only queues the frame, a background thread sends the newest one
+        self.async_send = async_send
+        self._mailbox = None
+        self._dropped_staged = deque() # tensor copies of dropped batches, the sender thread waits for and releases them
+        if async_send:
+            self._mailbox = LatestMailbox(mailbox_size)
+            self._sender = threading.Thread(target=self._sender_loop, daemon=True)
+            self._sender.start()
+        # a background thread connects with backoff, read() and send_images() only check connect_success
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self._connected = threading.Event()
+        self._disconnected = threading.Event()
+        self._disconnected.set()
+        self._connect_now = threading.Event() # cuts the connector's backoff short
+        self._closed = False
+        self._connector = threading.Thread(target=self._connect_loop, daemon=True)
+        self._connector.start()
     def reset_connect(self):
-        self.connect_success = False
-        self.socker.close()
+        with self._lock:
+            self.connect_success = False
+            self._connected.clear()
+            self._shm_ready = False
+            if self._delta is not None:
+                self._delta.request_keyframe() # whoever connects next has no canvas yet
+            if self.socker is not None:
+                self.socker.close()
+            self._disconnected.set()
+            self._connect_now.set()
     def send_current_state(self):
         status = self.peer_status["send"] if self.recieve_camera else self.peer_status["dont send"]
-        self.socker.sendall(i2b(status))
+        with self._send_lock:
+            self.socker.sendall(i2b(status))
     def i_dont_send_more_data(self):
-        self.socker.sendall(i2b(self.peer_status["dont receive"]))
+        with self._send_lock:
+            self.socker.sendall(i2b(self.peer_status["dont receive"]))
     def require_camera_from_remote(self, status):
         if self.recieve_camera!=status:
             self.recieve_camera = status
@@ -45,32 +129,163 @@ class RemoteViewer():
                 self.send_current_state()
 
     def try_connect(self):
-        if self.connect_success == False:
-            print("try_connect")
-            try:
-                self.socker = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socker.connect((self.host, self.port))
+        # no network here, the connector thread attaches us as soon as a viewer listens
+        return self.connect_success
+
+    def wait_for_viewer(self, timeout=None):
+        """Blocks until a viewer is connected, returns False on timeout."""
+        return self._connected.wait(timeout)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            # non-blocking connect, a firewalled host costs connect_timeout and not the OS timeout
+            sock.setblocking(False)
+            error = sock.connect_ex((self.host, self.port))
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise OSError(error, os.strerror(error))
+            if not select.select([], [sock], [], self.connect_timeout)[1]:
+                raise TimeoutError("connect timed out")
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise OSError(error, os.strerror(error))
+            sock.setblocking(True)
+            # cameras and frames are small request/response messages, Nagle plus delayed ACKs would hold them back
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                self.socker = sock
                 self.send_current_state() # synchronize camera state first
-                self.connect_success=True
-                return True
-            except Exception as e:
-                self.connect_success = False
-                return False
-        else:
-            return True
+                if self.transport == "shm":
+                    self._offer_shm()
+                self.connect_success = True
+                self._disconnected.clear()
+                self._connected.set()
+            log.info("connected to viewer %s:%d", self.host, self.port)
+        except Exception:
+            sock.close()
+            raise
+
+    def _connect_loop(self):
+        backoff = 0.1
+        while not self._closed:
+            self._disconnected.wait()
+            if self._closed:
+                return
+            try:
+                self._connect()
+                backoff = 0.1
+            except (OSError, ValueError) as e:
+                log.debug("no viewer at %s:%d (%s), retrying in %.1fs", self.host, self.port, e, backoff)
+                # a single image to send or a reset retries right away
+                self._connect_now.wait(backoff)
+                self._connect_now.clear()
+                backoff = min(backoff * 2, self.max_backoff)
+    def _offer_shm(self):
+        if self._shm is None:
+            try:
+                self._shm = ShmRing.create(self.shm_slots, self.shm_slot_bytes)
+            except OSError as e:
+                print("shared memory transport unavailable:", e)
+                self.transport = "tcp"
+                return
+        with self._send_lock:
+            self.socker.sendall(i2b(self.peer_status["shm"])+self._shm.offer())
     def close(self):
-        self.socker.close()
+        self._closed = True
+        self._disconnected.set() # wakes the connector so it can exit
+        self._connect_now.set()
+        if self._mailbox is not None:
+            self._mailbox.close()
+            self._sender.join()
+        if self._encoder is not None:
+            self._encoder.shutdown()
+        with self._lock:
+            if self.socker is not None:
+                self.socker.close()
+            self.connect_success = False
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+        if self._recorder is not None:
+            self._recorder.close()
+
+    def _poll_incoming(self):
+        # handles everything the viewer sent so far without blocking, keeps only the newest camera
+        while select.select([self.socker], [], [], 0)[0]:
+            head = b2i(recv_exact(self.socker, 4))
+            if head == 0:
+                self._queue_cameras(1, {0: self._read_camera_message()})
+            elif head == 4:
+                num_viewports, count = CAMERA_BATCH.unpack(recv_exact(self.socker, CAMERA_BATCH.size))
+                cameras = {}
+                for _ in range(count):
+                    viewport, = VIEWPORT.unpack(recv_exact(self.socker, VIEWPORT.size))
+                    cameras[viewport] = self._read_camera_message()
+                self._queue_cameras(num_viewports, cameras)
+            elif head == 1:
+                self._shm_ready = b2i(recv_exact(self.socker, 4)) == 1
+            elif head == 2 and self._delta is not None:
+                self._delta.request_keyframe()
+            elif head == 3:
+                sent_at, = QUALITY_ECHO.unpack(recv_exact(self.socker, QUALITY_ECHO.size))
+                if self.quality is not None:
+                    self.quality.observe_rtt(time.perf_counter() - sent_at)
+
+    def _read_camera_message(self):
+        message = self._read_buffer(CAMERA_MESSAGE.size)
+        camera = unpack_camera(message)
+        camera["message"] = bytes(message)
+        self.pool.release(message)
+        camera["window_sizes"] = unpack_window_sizes(recv_exact(self.socker, camera["num_windows"] * WINDOW_SIZE.size))
+        return camera
+
+    def _queue_cameras(self, num_viewports, cameras):
+        # a batch only holds the viewports that changed, the newest camera of each wins
+        self._num_viewports = num_viewports
+        if self._new_cameras is None:
+            self._new_cameras = {}
+        self._new_cameras.update(cameras)
+
+    def _update_cameras(self):
+        cameras, self._new_cameras = self._new_cameras, None
+        for viewport, camera in cameras.items():
+            self.viewport_cameras[viewport] = (camera, self._read_cameras(camera))
+        for viewport in [v for v in self.viewport_cameras if v >= self._num_viewports]: # closed viewports
+            del self.viewport_cameras[viewport]
+        if cameras:
+            newest = max(cameras.values(), key=lambda camera: camera["seq"])
+            self.camera_seq = newest["seq"]
+            self.camera_time = newest["timestamp"]
+        if 0 in self.viewport_cameras:
+            camera, self.camera = self.viewport_cameras[0]
+            self._camera_message = camera["message"]
+            self.resolution = (camera["height"], camera["width"]) if camera["width"] and camera["height"] else None
+            self.window_sizes = camera["window_sizes"]
+        self.viewports = sorted(self.viewport_cameras)
+        self.cameras = [self.viewport_cameras[v][1] for v in self.viewports]
+        if self.viewports:
+            self.camera_batch = self._stack_cameras([self.viewport_cameras[v][0] for v in self.viewports])
 
     def read(self):
+        # never blocks: drains every queued camera message and returns the newest one,
+        # or the last known camera if nothing new arrived
         has_viewer = self.try_connect()
         if has_viewer:
             try:
-                print("read")
-                head = self.socker.recv(4)
-                head = b2i(head)
+                log.debug("read")
+                self._poll_incoming()
+                if self._new_cameras is not None:
+                    self._update_cameras()
                 ret_dict = {"status":1}
-                if head == 0:
-                     ret_dict["camera"] = self._read_cameras()
+                if self.camera is not None:
+                    ret_dict["camera"] = self.camera
+                    ret_dict["camera_seq"] = self.camera_seq
+                    ret_dict["resolution"] = self.resolution # render at this size, it is what the viewer displays
+                    ret_dict["window_sizes"] = self.window_sizes
+                    # every viewport, render them all and send_images(images, viewports=ret_dict["viewports"])
+                    ret_dict["viewports"] = self.viewports
+                    ret_dict["cameras"] = self.cameras
+                    ret_dict["camera_batch"] = self.camera_batch
                 return ret_dict
             except Exception as e:
                 print(e)
@@ -79,47 +294,196 @@ class RemoteViewer():
                 return {"status":0}
         return {"status":0}
 
-    def send_images(self,images:list,single=False): #W
-        has_viewer = self.try_connect()
-        if has_viewer:
-            try:
-                if isinstance(images,list)==False:
-                    images = [images]
-                # print("send_images")
-                import numpy as np
-                num = len(images)
-                self.socker.sendall(i2b(self.peer_status["image"])+i2b(num))
-                for i in range(num):
-                    image = images[i]
-                    image = np.array(image)
-                    img_str = pickle.dumps(image)
-                    image_bytes = zlib.compress(img_str,zlib.Z_BEST_COMPRESSION)
-                    length = len(image_bytes)
-                    # image_bytes = image.astype(np.uint8).tobytes()
-                    width,height = image.shape[0].to_bytes(4,"little"),image.shape[1].to_bytes(4,"little")
-                    self.socker.sendall(i2b(length)+width+height)
-                    self.socker.sendall(image_bytes)
-                if single:
-                    self.i_dont_send_more_data()
-                # print("send done")
-            except Exception as e:
-                # assume the connection is broken
-                self.reset_connect()
-    def _read_cameras(self):
-        message_length = self.socker.recv(4)
-        message_length = b2i(message_length)
-        messages = self._read_buffer(message_length)
-        fovx,znear,zfar,world_view_transform,full_proj_transform = pickle.loads(messages)
-        world_view_transform = world_view_transform.to("cuda")
-        full_proj_transform = full_proj_transform.to("cuda")
-        return GS_Cam(0,0,fovx,fovx,znear,zfar,world_view_transform,full_proj_transform)
+    def send_images(self,images:list,single=False,codec=None,camera_seq=None,depths=None,viewports=None): #W
+        # images: numpy arrays or torch tensors, float CHW tensors in [0, 1] are converted on their device
+        # camera_seq: the camera these images were rendered with, the newest one read() returned by default
+        # depths: optional view space depth (H x W) of each image, None for no depth, lets the viewer reproject
+        # viewports: the viewport each image was rendered for, images may then also be one stacked batch
+        # a single image is worth waiting a moment for the viewer, a stream just skips frames until it is there
+        if single and not self.try_connect():
+            self._connect_now.set() # the connector may be in a long backoff, try now
+        has_viewer = self.try_connect() or (single and self.wait_for_viewer(self.connect_timeout))
+        if has_viewer or self._recorder is not None:
+            if isinstance(images,list)==False:
+                images = list(images) if viewports is not None else [images]
+            if viewports is not None and len(viewports) != len(images):
+                raise ValueError(f"{len(images)} images for {len(viewports)} viewports")
+            if depths is not None and len(depths) != len(images):
+                raise ValueError(f"{len(images)} images for {len(depths)} depths, pass None for an image without one")
+            codec = None if codec is None else codec_id(codec)
+            if depths is not None:
+                depths = [None if depth is None else to_depth_array(depth) for depth in depths]
+            if camera_seq in (None, self.camera_seq):
+                camera = (self.camera_seq, self.camera_time, self._camera_message)
+            else:
+                camera = (camera_seq, 0.0, None)
+            if has_viewer and (self._delta is not None or self.quality is not None or (self._shm is not None and not self._shm_ready)):
+                try:
+                    self._poll_incoming() # keyframe requests, report echoes, answer to our shared memory offer
+                except Exception as e:
+                    self.reset_connect()
+                    return
+            staged = None
+            if any(is_tensor(image) for image in images):
+                if self._stager is None:
+                    self._stager = TensorStager()
+                with timer.stage("stage"): # device to host copies are only queued here
+                    images, staged = self._stager.stage(images, copy=self.async_send)
+            elif self.async_send:
+                # copy, the caller is free to overwrite its arrays as soon as we return
+                with timer.stage("copy"):
+                    images = [np.array(image) for image in images]
+            if self.async_send:
+                dropped = self._mailbox.put((images, single, codec, camera, staged, depths, viewports))
+                if dropped is not None:
+                    self.frames_dropped += 1
+                    if dropped[4] is not None:
+                        self._dropped_staged.append(dropped[4])
+                return
+            self._send_batch(images, single, codec, camera, staged, depths, viewports)
+            if staged is not None:
+                staged.release()
+
+    def _send_batch(self, images, single, codec, camera, staged=None, depths=None, viewports=None):
+        connected = self.connect_success
+        if not connected and self._recorder is None:
+            return False
+        try:
+            if staged is not None:
+                with timer.stage("device to host"):
+                    staged.wait()
+            begin = time.perf_counter()
+            level = None
+            if self.quality is not None:
+                setting = self.quality.current()
+                with timer.stage("quality"):
+                    images = [apply_quality(image, setting["bits"], setting["scale"]) for image in images]
+                    if depths is not None: # same size as its image, the bits only apply to 8-bit images
+                        depths = [None if depth is None else apply_quality(depth, 8, setting["scale"]) for depth in depths]
+                if codec is None:
+                    codec, level = setting["codec"], setting["codec_level"]
+            if codec is None:
+                codec = self.codec
+            depths = depths or [None] * len(images)
+            num = len(images) + sum(depth is not None for depth in depths)
+            viewports = viewports or []
+            sent_time = time.time()
+            batch_header = i2b(self.peer_status["image"])+BATCH_HEADER.pack(num, camera[0], camera[1], sent_time,
+                                                                            len(viewports))+pack_viewport_ids(viewports)
+            buffers = None
+            if connected:
+                with timer.stage("encode"):
+                    buffers = [batch_header] + self._frame_buffers(self._encode(images, codec, level), depths, codec)
+            encoded = time.perf_counter()
+            if self._recorder is not None:
+                with timer.stage("record"):
+                    self._record(batch_header, buffers, images, depths, codec, level, camera, sent_time)
+            if not connected:
+                return True
+            with self._send_lock, timer.stage("send"):
+                send_buffers(self.socker, buffers)
+            if single:
+                self.i_dont_send_more_data()
+            self.frames_sent += 1
+            if self.quality is not None:
+                sent = time.perf_counter()
+                changed = self.quality.observe_frame(encoded - begin, sum(len(b) for b in buffers), sent - encoded)
+                if changed or sent - self._last_report > 0.5:
+                    self._send_quality_report(sent)
+            return True
+        except Exception as e:
+            # assume the connection is broken
+            self.reset_connect()
+            return False
+
+    def _frame_buffers(self, frames, depths, codec):
+        # [header, payload, ...] of the encoded images, each depth right after its image
+        buffers = []
+        for (header, payload), depth in zip(frames, depths):
+            buffers += [header, payload]
+            if depth is not None: # always over the socket
+                buffers += encode_frame(depth, CODEC_NONE if codec == CODEC_NONE else "zlib", FLAG_DEPTH)
+        return buffers
+
+    def _record(self, batch_header, buffers, images, depths, codec, level, camera, sent_time):
+        # the recorder's thread encodes and writes, what the caller or the stager may reuse is copied first.
+        # Delta frames and shared memory references mean nothing outside this connection, those are encoded again
+        if buffers is None or self._delta is not None or self._shm_ready:
+            images = [np.array(image) for image in images]
+            encode = lambda: [batch_header] + self._frame_buffers(
+                [encode_frame(image, codec, level=level) for image in images], depths, codec)
+        else:
+            # uncompressed payloads are views of the images
+            buffers = [buf if isinstance(buf, bytes) else bytes(buf) for buf in buffers]
+            encode = lambda: buffers
+        self._recorder.submit(encode, camera[2], camera[0], camera[1], sent_time)
+
+    def _send_quality_report(self, now):
+        # tells the viewer what we picked, its echo gives us the round trip time
+        self._last_report = now
+        with self._send_lock:
+            self.socker.sendall(i2b(self.peer_status["quality"])+self.quality.report(now))
+
+    def _encode(self, images, codec, level=None):
+        if self._delta is not None: # delta frames are small, they always go over the socket
+            encode = lambda i: self._delta.encode(i, images[i], codec, level)
+        elif self._shm_ready:
+            return [self._encode_shm(image, codec) for image in images]
+        else:
+            encode = lambda i: encode_frame(images[i], codec, level=level)
+        if codec == CODEC_NONE or len(images) < 2 or self.encode_workers < 2:
+            return [encode(i) for i in range(len(images))]
+        if self._encoder is None:
+            self._encoder = ThreadPoolExecutor(self.encode_workers, thread_name_prefix="RemoteViewer-encode")
+        return list(self._encoder.map(encode, range(len(images))))
+
+    def _encode_shm(self, image, codec):
+        image = np.ascontiguousarray(image)
+        ref = self._shm.write(image)
+        if ref is None: # larger than a slot
+            return encode_frame(image, codec)
+        return frame_header(image, CODEC_SHM, len(ref)), ref
+
+    def _sender_loop(self):
+        while True:
+            frame = self._mailbox.get()
+            while self._dropped_staged:
+                self._dropped_staged.popleft().release()
+            if frame is None: # closed
+                return
+            if not self._send_batch(*frame):
+                self.frames_dropped += 1
+            if frame[4] is not None:
+                frame[4].release()
+
+    def stats(self):
+        stats = {"frames_sent": self.frames_sent, "frames_dropped": self.frames_dropped}
+        if self.quality is not None:
+            stats["quality"] = self.quality.current()
+            stats["rtt"] = self.quality.rtt
+            stats["throughput"] = self.quality.throughput
+        return stats
+    def _read_cameras(self, camera):
+        # imported on the first camera, sending images works without torch
+        import torch
+        from m_scripts.camera_utils import GS_Cam
+        world_view_transform = torch.from_numpy(camera["world_view_transform"]).to(self.device)
+        full_proj_transform = torch.from_numpy(camera["full_proj_transform"]).to(self.device)
+        return GS_Cam(camera["width"],camera["height"],camera["fovy"],camera["fovx"],camera["znear"],camera["zfar"],
+                      world_view_transform,full_proj_transform)
+
+    def _stack_cameras(self, cameras):
+        # one tensor per field with a leading viewport dimension, to rasterize every view in one batched call
+        import torch
+        stacked = {name: np.stack([camera[name] for camera in cameras])
+                   for name in ("world_view_transform", "full_proj_transform")}
+        stacked.update({name: np.array([camera[name] for camera in cameras], dtype=np.float32)
+                        for name in ("fovx", "fovy", "znear", "zfar")})
+        batch = {name: torch.from_numpy(value).to(self.device) for name, value in stacked.items()}
+        batch["width"] = [camera["width"] for camera in cameras]
+        batch["height"] = [camera["height"] for camera in cameras]
+        return batch
 
     def _read_buffer(self, messageLength):
-        img_arr_bytes = b''
-        while len(img_arr_bytes) < messageLength:
-            chunk = self.socker.recv(messageLength - len(img_arr_bytes))
-            if not chunk:
-                break
-            img_arr_bytes += chunk
-        return img_arr_bytes
+        return recv_into_exact(self.socker, self.pool.acquire(messageLength))
 
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmarks for the streaming path, run headless over loopback.
+#
+#   python benchmark.py recv --size-mb 6 --count 50
+#   python benchmark.py camera
+#   python benchmark.py stream --resolutions 512x512,1080x1920 --codecs none,zlib --output stream.json
+#
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+from protocol import b2i, i2b, BufferPool, recv_exact, recv_into_exact, available_codecs
+
+def _loopback_pair():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    server.close()
+    for sock in (client, conn): # like the RemoteViewer/RemoteRenderer connections
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client, conn
+
+def _recv_concat(conn, message_length):
+    # the receive loop used before the buffer pool
+    img_arr_bytes = b''
+    while len(img_arr_bytes) < message_length:
+        chunk = conn.recv(message_length - len(img_arr_bytes))
+        if not chunk:
+            break
+        img_arr_bytes += chunk
+    return img_arr_bytes
+
+def bench_recv(size, count):
+    payload = bytes(size)
+    results = {}
+    for name in ("concat", "recv_into"):
+        client, conn = _loopback_pair()
+        pool = BufferPool()
+        def sender():
+            for _ in range(count):
+                client.sendall(i2b(size))
+                client.sendall(payload)
+        thread = threading.Thread(target=sender, daemon=True)
+        begin = time.perf_counter()
+        thread.start()
+        for _ in range(count):
+            length = b2i(recv_exact(conn, 4))
+            if name == "concat":
+                _recv_concat(conn, length)
+            else:
+                pool.release(recv_into_exact(conn, pool.acquire(length)))
+        elapsed = time.perf_counter() - begin
+        thread.join()
+        client.close()
+        conn.close()
+        results[name] = size * count / elapsed / 1e6
+        print(f"{name:>10}: {results[name]:10.1f} MB/s")
+    return results
+
+def _import_cost(module):
+    # fresh interpreter per module: wall time of the import and peak RSS of the process
+    code = ("import resource, time; t = time.perf_counter(); import {}; "
+            "print(time.perf_counter() - t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)").format(module)
+    # from the repository, whatever directory the benchmark is started from
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        return None
+    seconds, maxrss_kb = result.stdout.split()
+    return float(seconds), int(maxrss_kb) / 1024
+
+def bench_camera(calls):
+    print("startup (import in a fresh interpreter):")
+    for module in ("camera", "torch"):
+        cost = _import_cost(module)
+        if cost is None:
+            print(f"{module:>10}: not installed")
+        else:
+            print(f"{module:>10}: {cost[0] * 1e3:8.1f} ms, peak RSS {cost[1]:7.1f} MB")
+    from camera import Camera, from_cam_to_GSCAM_dict
+    camera = Camera(512, 512)
+    print("per call:")
+    for name, dirty in (("dirty", True), ("cached", False)):
+        begin = time.perf_counter()
+        for _ in range(calls):
+            if dirty:
+                camera.is_pose_dirty = True
+                camera.is_intrin_dirty = True
+            from_cam_to_GSCAM_dict(camera)
+        elapsed = time.perf_counter() - begin
+        print(f"{name:>10}: {elapsed / calls * 1e6:8.2f} us per camera")
+
+def _synthetic_frames(height, width, channels, variants=4):
+    # smooth gradients with a little noise, shifted every frame: compresses like a rendering, not like noise
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:height, :width]
+    base = np.stack([(x * 255 // max(width - 1, 1) + 85 * c + y // 4) % 256 for c in range(channels)], axis=-1)
+    frames = []
+    for k in range(variants):
+        noise = rng.integers(0, 8, base.shape)
+        frames.append(np.ascontiguousarray(np.roll(base, 16 * k, axis=1) + noise, dtype=np.uint8))
+    return frames
+
+def _stream_sender(port, codec, shape, batch, count, fps, results):
+    # the renderer side, in its own process so both sides get their own CPU time and GIL
+    from RemoteViewer import RemoteViewer
+    frames = _synthetic_frames(*shape)
+    viewer = RemoteViewer("127.0.0.1", port, codec=codec)
+    viewer.wait_for_viewer(30)
+    cpu = time.process_time()
+    start = time.time() # wall clock, the receiver in the other process compares its arrivals to it
+    begin = time.perf_counter()
+    for k in range(count):
+        if fps: # paced like a renderer, otherwise latency is mostly time spent queued in the socket
+            time.sleep(max(0.0, begin + k / fps - time.perf_counter()))
+        viewer.send_images([frames[(k + i) % len(frames)] for i in range(batch)])
+    results.put((time.process_time() - cpu, start))
+    viewer.close()
+
+def bench_stream_once(codec, shape, batch, count, fps=0, timeout=30.0):
+    from RemoteRenderer import RemoteRenderer
+    renderer = RemoteRenderer(host="127.0.0.1", port=0)
+    port = renderer.socker.getsockname()[1]
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    sender = context.Process(target=_stream_sender, args=(port, codec, shape, batch, count, fps, results), daemon=True)
+    sender.start()
+
+    latencies, arrivals, nbytes = [], [], 0
+    cpu = time.process_time()
+    while len(arrivals) < count:
+        remote_info = renderer.read(timeout)
+        if remote_info["status"] == 0 or remote_info.get("closed"):
+            break # a stuck or lost sender ends the run instead of hanging it
+        if "image" not in remote_info:
+            continue
+        now = time.time()
+        images = [image for image in remote_info["image"] if image is not None]
+        latencies.append(now - remote_info["batch"]["sent_time"])
+        arrivals.append(now)
+        nbytes += sum(image.nbytes for image in images)
+        renderer.recycle(images)
+    receiver_cpu = time.process_time() - cpu
+    sender_cpu, sender_start = results.get(timeout=timeout) if len(arrivals) == count else (None, None)
+    sender.join(timeout)
+    renderer.close()
+
+    height, width, channels = shape
+    result = {"codec": codec, "height": height, "width": width, "channels": channels, "batch": batch,
+              "target_fps": fps, "frames": len(arrivals)}
+    if len(arrivals) > 1 and sender_start is not None:
+        # from the sender's first send to the last arrival: timing the receiver alone would only
+        # measure how fast it drains what piled up in the socket while it was busy
+        elapsed = arrivals[-1] - sender_start
+        result["fps"] = len(arrivals) / elapsed
+        result["mb_per_s"] = nbytes / elapsed / 1e6
+        result["latency_p50_ms"], result["latency_p99_ms"] = (np.percentile(latencies, [50, 99]) * 1e3).tolist()
+        result["receiver_cpu_ms_per_batch"] = receiver_cpu / len(arrivals) * 1e3
+        if sender_cpu is not None:
+            result["sender_cpu_ms_per_batch"] = sender_cpu / count * 1e3
+    return result
+
+def _shape(text):
+    height, width = text.lower().split("x")
+    return int(height), int(width)
+
+def bench_stream(resolutions, channels, batches, codecs, count, fps, output):
+    results = []
+    print(f"{'codec':>6} {'resolution':>10} {'ch':>3} {'batch':>5} {'fps':>8} {'MB/s':>8} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'cpu tx':>8} {'cpu rx':>8}")
+    for codec in codecs:
+        if codec not in available_codecs():
+            print(f"{codec:>6}: not available, skipped")
+            continue
+        for height, width in resolutions:
+            for channel in channels:
+                for batch in batches:
+                    result = bench_stream_once(codec, (height, width, channel), batch, count, fps)
+                    results.append(result)
+                    if "fps" not in result:
+                        print(f"{codec:>6} {height}x{width:<5} {channel:>3} {batch:>5}: "
+                              f"only {result['frames']} of {count} batches arrived")
+                        continue
+                    print(f"{codec:>6} {height}x{width:<5} {channel:>3} {batch:>5} {result['fps']:8.1f} "
+                          f"{result['mb_per_s']:8.1f} {result['latency_p50_ms']:8.2f} {result['latency_p99_ms']:8.2f} "
+                          f"{result.get('sender_cpu_ms_per_batch', float('nan')):8.2f} "
+                          f"{result['receiver_cpu_ms_per_batch']:8.2f}")
+    if output:
+        with open(output, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "system": platform.system(), "frames_per_config": count, "target_fps": fps,
+                       "results": results}, f, indent=1)
+        print(f"results written to {output}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="micro-benchmarks for the streaming path")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    recv = sub.add_parser("recv", help="receive loop throughput over loopback")
+    recv.add_argument("--size-mb", type=float, default=6.0)
+    recv.add_argument("--count", type=int, default=50)
+    camera = sub.add_parser("camera", help="viewer startup and camera matrix cost")
+    camera.add_argument("--calls", type=int, default=10000)
+    stream = sub.add_parser("stream", help="RemoteViewer -> RemoteRenderer over loopback, swept over settings")
+    stream.add_argument("--resolutions", default="256x256,512x512,1080x1920", help="comma separated HEIGHTxWIDTH")
+    stream.add_argument("--channels", default="3,4")
+    stream.add_argument("--batch", default="1,2", help="images per send_images call")
+    stream.add_argument("--codecs", default="none,zlib,lz4")
+    stream.add_argument("--count", type=int, default=100, help="batches per setting")
+    stream.add_argument("--fps", type=float, default=0, help="pace the sender, 0: as fast as possible")
+    stream.add_argument("--output", default="stream_benchmark.json", help="JSON results, empty to skip")
+    args = parser.parse_args()
+    if args.bench == "recv":
+        bench_recv(int(args.size_mb * 1e6), args.count)
+    elif args.bench == "camera":
+        bench_camera(args.calls)
+    elif args.bench == "stream":
+        bench_stream([_shape(r) for r in args.resolutions.split(",")],
+                     [int(c) for c in args.channels.split(",")],
+                     [int(b) for b in args.batch.split(",")],
+                     args.codecs.split(","), args.count, args.fps, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import numpy as np
+
+# from controller: input->model-view matrix
+# from application: model-view matrix
+def normalize_vecs(vectors: np.ndarray) -> np.ndarray:
+    '''
+    From EG3D
+    '''
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+def look_at_view_matrix(origin, target):
+    """
+    World-to-camera matrix of a camera at `origin` looking at `target`.
+    Assumes y-axis is up and that there is no camera roll (same convention as EG3D's create_cam2world_matrix).
+    The camera-to-world transform is rigid, so its inverse is [R^T | -R^T t] in closed form.
+    """
+    forward_vector = normalize_vecs(target - origin)
+    up_vector = np.array([0, 1, 0], dtype=np.float32)
+    right_vector = -normalize_vecs(np.cross(up_vector, forward_vector))
+    up_vector = normalize_vecs(np.cross(forward_vector, right_vector))
+    rotation_t = np.stack((right_vector, up_vector, forward_vector)) # rows: R^T
+    view_matrix = np.eye(4, dtype=np.float32)
+    view_matrix[:3, :3] = rotation_t
+    view_matrix[:3, 3] = -rotation_t @ origin
+    return view_matrix
+def as_tensor(matrix):
+    # torch is only imported when a caller really wants tensors
+    import torch
+    return torch.from_numpy(matrix)
+
+class Camera:
+    def __init__(self, h, w):
+        self.znear = 0.01
+        self.zfar = 1000
+        self.h = h
+        self.w = w
+        self.fovy = 20 / 180 * np.pi
+        self.position = np.array([0.0, 0.0, -5.6]).astype(np.float32)
+        self.target = np.array([0.0, 0.0, 0.0]).astype(np.float32)
+        self.up = -np.array([0.0, 1.0, 0.0]).astype(np.float32)
+        self.yaw = np.pi / 2
+        self.pitch = 0
+
+        self._view_matrix = None
+        self._project_matrix = None
+        self.is_pose_dirty = True
+        self.is_intrin_dirty = True
+
+        self.last_x = 640
+        self.last_y = 360
+        self.first_mouse = True
+
+        self.is_leftmouse_pressed = False
+        self.is_rightmouse_pressed = False
+
+        self.rot_sensitivity = -0.02
+        self.trans_sensitivity = -0.01
+        self.zoom_sensitivity = 0.08
+        self.roll_sensitivity = 0.03
+        self.target_dist = 3.
+
+    # marking the pose/intrinsics dirty also drops the cached matrices
+    @property
+    def is_pose_dirty(self):
+        return self._is_pose_dirty
+    @is_pose_dirty.setter
+    def is_pose_dirty(self, dirty):
+        self._is_pose_dirty = dirty
+        if dirty:
+            self._view_matrix = None
+    @property
+    def is_intrin_dirty(self):
+        return self._is_intrin_dirty
+    @is_intrin_dirty.setter
+    def is_intrin_dirty(self, dirty):
+        self._is_intrin_dirty = dirty
+        if dirty:
+            self._project_matrix = None
+
+    def _global_rot_mat(self):
+        x = np.array([1, 0, 0])
+        z = np.cross(x, self.up)
+        z = z / np.linalg.norm(z)
+        x = np.cross(self.up, z)
+        return np.stack([x, self.up, z], axis=-1)
+
+    def get_view_matrix(self, tensor=False):
+        if self._view_matrix is None:
+            self._view_matrix = look_at_view_matrix(self.position, self.target)
+        return as_tensor(self._view_matrix) if tensor else self._view_matrix
+
+    def get_project_matrix(self, tensor=False):
+        if self._project_matrix is None:
+            htanx, htany, focal = self.get_htanfovxy_focal()
+            f_n = self.zfar - self.znear
+            self._project_matrix = np.array([
+                1 / htanx, 0, 0, 0,
+                0, 1 / htany, 0, 0,
+                0, 0, self.zfar / f_n, - 2 * self.zfar * self.znear / f_n,
+                0, 0, 1, 0
+            ], dtype=np.float32).reshape(4,4)
+        proj_mat = self._project_matrix
+        # project_mat = glm.perspective(
+        #     self.fovy,
+        #     self.w / self.h,
+        #     self.znear,
+        #     self.zfar
+        # )
+        return as_tensor(proj_mat) if tensor else proj_mat
+
+    def get_htanfovxy_focal(self):
+        htany = np.tan(self.fovy / 2)
+        htanx = htany / self.h * self.w
+        focal = self.h / (2 * htany)
+        return [htanx, htany, focal]
+
+    def get_focal(self):
+        return self.h / (2 * np.tan(self.fovy / 2))
+
+    def process_mouse(self, xpos, ypos):
+        if self.first_mouse:
+            self.last_x = xpos
+            self.last_y = ypos
+            self.first_mouse = False
+
+        xoffset = xpos - self.last_x
+        yoffset = self.last_y - ypos
+        self.last_x = xpos
+        self.last_y = ypos
+
+        if self.is_leftmouse_pressed:
+            self.yaw += xoffset * self.rot_sensitivity
+            self.pitch += yoffset * self.rot_sensitivity
+
+            self.pitch = np.clip(self.pitch, -np.pi / 2, np.pi / 2)
+
+            front = np.array([np.cos(self.yaw) * np.cos(self.pitch),
+                              np.sin(self.pitch), np.sin(self.yaw) *
+                              np.cos(self.pitch)])
+            front = self._global_rot_mat() @ front.reshape(3, 1)
+            front = front[:, 0]
+            self.position[:] = - front * np.linalg.norm(self.position - self.target) + self.target
+
+            self.is_pose_dirty = True
+
+        if self.is_rightmouse_pressed:
+            front = self.target - self.position
+            front = front / np.linalg.norm(front)
+            right = np.cross(self.up, front)
+            self.position += right * xoffset * self.trans_sensitivity
+            self.target += right * xoffset * self.trans_sensitivity
+            cam_up = np.cross(right, front)
+            self.position += cam_up * yoffset * self.trans_sensitivity
+            self.target += cam_up * yoffset * self.trans_sensitivity
+
+            self.is_pose_dirty = True
+
+    def process_wheel(self, dx, dy):
+        front = self.target - self.position
+        front = front / np.linalg.norm(front)
+        self.position += front * dy * self.zoom_sensitivity
+      #  self.target += front * dy * self.zoom_sensitivity
+        self.is_pose_dirty = True
+
+    def process_roll_key(self, d):
+        front = self.target - self.position
+        right = np.cross(front, self.up)
+        new_up = self.up + right * (d * self.roll_sensitivity / np.linalg.norm(right))
+        self.up = new_up / np.linalg.norm(new_up)
+        self.is_pose_dirty = True
+
+    def flip_ground(self):
+        self.up = -self.up
+        self.is_pose_dirty = True
+
+    def update_target_distance(self):
+        _dir = self.target - self.position
+        _dir = _dir / np.linalg.norm(_dir)
+        self.target = self.position + _dir * self.target_dist
+
+    def update_resolution(self, height, width):
+        self.h = max(height, 1)
+        self.w = max(width, 1)
+        self.is_intrin_dirty = True
+def from_cam_to_GSCAM_dict(g_camera:Camera, tensor=False):
+    fovy = g_camera.fovy
+    fovx = 2 * np.arctan(g_camera.get_htanfovxy_focal()[0]) # equals fovy for square windows
+    znear = g_camera.znear
+    zfar = g_camera.zfar
+    world_view_transform = g_camera.get_view_matrix()
+
+    proj_transform = g_camera.get_project_matrix()
+    full_proj_transform = proj_transform@world_view_transform
+    if tensor:
+        world_view_transform, full_proj_transform = as_tensor(world_view_transform), as_tensor(full_proj_transform)
+
+    return [fovx,znear,zfar,world_view_transform,full_proj_transform]
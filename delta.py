@@ -0,0 +1,103 @@
+#
+# Tile based delta encoding for mostly static streams.
+#
+# A delta frame only carries the tiles that changed since the previous frame
+# of the same window. Its payload, before the stream codec is applied, is
+#   DELTA_HEADER | changed tile mask (np.packbits, row major) | changed tiles
+# where every tile is tile x tile pixels, the last row/column of tiles being
+# padded. Keyframes are ordinary frames flagged FLAG_KEYFRAME: the viewer keeps
+# them as the canvas the following delta frames are patched into.
+#
+
+import struct
+import numpy as np
+from protocol import FLAG_DELTA, FLAG_KEYFRAME, codec_id, compress_payload, frame_header, encode_frame
+
+DELTA_HEADER = struct.Struct("<HHH") # tile size, tiles along y, tiles along x
+
+def _grid(shape, tile):
+    return -(-shape[0] // tile), -(-shape[1] // tile)
+
+def _tiled(image, tile):
+    """(ty, tx, tile, tile, ...) view of an image padded to whole tiles."""
+    ty, tx = _grid(image.shape, tile)
+    return image.reshape((ty, tile, tx, tile) + image.shape[2:]).swapaxes(1, 2)
+
+def _pad(image, tile):
+    ty, tx = _grid(image.shape, tile)
+    pad = [(0, ty * tile - image.shape[0]), (0, tx * tile - image.shape[1])] + [(0, 0)] * (image.ndim - 2)
+    return np.pad(image, pad) if any(p[1] for p in pad) else image
+
+class DeltaEncoder():
+    def __init__(self, tile=32, threshold=0, keyframe_interval=120):
+        self.tile = tile
+        self.threshold = threshold # a tile is sent when a pixel differs by more than this
+        self.keyframe_interval = keyframe_interval
+        self.references = {} # window index -> padded frame as the viewer shows it
+        self.since_keyframe = {}
+        self.generation = 0 # bumped to turn the next frame of every window into a keyframe
+        self.keyframe_generation = {}
+
+    def request_keyframe(self):
+        # may be called from another thread than encode()
+        self.generation += 1
+
+    def encode(self, index, image, codec, level=None):
+        image = np.ascontiguousarray(image)
+        if image.ndim < 2:
+            return encode_frame(image, codec, level=level)
+        padded = _pad(image, self.tile)
+        reference = self.references.get(index)
+        generation = self.generation
+        if (reference is None or reference.shape != padded.shape or reference.dtype != padded.dtype
+                or self.since_keyframe[index] >= self.keyframe_interval
+                or self.keyframe_generation[index] != generation):
+            self.references[index] = padded.copy()
+            self.since_keyframe[index] = 0
+            self.keyframe_generation[index] = generation
+            return encode_frame(image, codec, flags=FLAG_KEYFRAME, level=level)
+        self.since_keyframe[index] += 1
+
+        diff = np.maximum(padded, reference) - np.minimum(padded, reference) # no unsigned wrap around
+        tiled_diff = _tiled(diff, self.tile)
+        changed = tiled_diff.reshape(tiled_diff.shape[:2] + (-1,)).max(axis=-1) > self.threshold
+        tiles = _tiled(padded, self.tile)[changed]
+        _tiled(reference, self.tile)[changed] = tiles
+
+        ty, tx = changed.shape
+        raw = b"".join((DELTA_HEADER.pack(self.tile, ty, tx), np.packbits(changed).tobytes(),
+                        memoryview(tiles).cast("B") if tiles.size else b""))
+        cid = codec_id(codec)
+        payload = compress_payload(raw, cid, level)
+        return frame_header(image, cid, len(payload), flags=FLAG_DELTA, raw_nbytes=len(raw)), payload
+
+class DeltaDecoder():
+    def __init__(self):
+        self.canvases = {} # window index -> padded canvas
+
+    def reset(self):
+        self.canvases.clear()
+
+    def keyframe(self, index, image):
+        self.canvases[index] = np.array(image) # own copy, `image` goes back to the buffer pool
+
+    def decode(self, index, info, raw, out):
+        """Patches a delta frame into the canvas of `index` and copies the result into `out`
+        (a writable array of the frame's shape). Returns False if there is no matching canvas."""
+        tile, ty, tx = DELTA_HEADER.unpack_from(raw)
+        canvas = self.canvases.get(index)
+        padded_shape = (ty * tile, tx * tile) + info["shape"][2:]
+        if canvas is None or canvas.dtype != info["dtype"]:
+            return False
+        if canvas.shape != padded_shape:
+            if canvas.shape != info["shape"]:
+                return False
+            canvas = self.canvases[index] = _pad(canvas, tile)
+        mask_nbytes = -(-(ty * tx) // 8)
+        begin = DELTA_HEADER.size
+        changed = np.unpackbits(np.frombuffer(raw, np.uint8, mask_nbytes, begin), count=ty * tx).astype(bool)
+        changed = changed.reshape(ty, tx)
+        tiles = np.frombuffer(raw, info["dtype"], offset=begin + mask_nbytes)
+        _tiled(canvas, tile)[changed] = tiles.reshape((-1, tile, tile) + info["shape"][2:])
+        out[...] = canvas[:info["shape"][0], :info["shape"][1]]
+        return True
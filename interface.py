@@ -3,211 +3,47 @@ from array import array
 from imgui.integrations.glfw import GlfwRenderer
 from math import sin, pi
 from random import random
-from time import time
+from time import time, strftime
+from collections import deque, OrderedDict
 import OpenGL.GL as gl
 import glfw
 import imgui
 import sys
-import glm
-from RemoteRenderer import RemoteRenderer
-import pickle
-import torch
-
-# from controller: input->model-view matrix
-# from application: model-view matrix
-def normalize_vecs(vectors: torch.Tensor) -> torch.Tensor:
-    '''
-    From EG3D
-    '''
-    return vectors / (torch.norm(vectors, dim=-1, keepdim=True))
-def create_cam2world_matrix(forward_vector, origin):
-    """
-    Takes in the direction the camera is pointing and the camera origin and returns a cam2world matrix.
-    Works on batches of forward_vectors, origins. Assumes y-axis is up and that there is no camera roll.
-    """
-
-
-    forward_vector = normalize_vecs(forward_vector)
-    up_vector = torch.tensor([0, 1, 0], dtype=torch.float,
-                             device=origin.device).expand_as(forward_vector)
-
-    right_vector = - \
-        normalize_vecs(torch.cross(up_vector, forward_vector, dim=-1))
-    up_vector = normalize_vecs(torch.cross(
-        forward_vector, right_vector, dim=-1))
-
-    rotation_matrix = torch.eye(4, device=origin.device).unsqueeze(
-        0).repeat(forward_vector.shape[0], 1, 1)
-    rotation_matrix[:, :3, :3] = torch.stack(
-        (right_vector, up_vector, forward_vector), axis=-1)
-
-    translation_matrix = torch.eye(4, device=origin.device).unsqueeze(
-        0).repeat(forward_vector.shape[0], 1, 1)
-    translation_matrix[:, :3, 3] = origin
-    cam2world = (translation_matrix @ rotation_matrix)[:, :, :]
-    assert (cam2world.shape[1:] == (4, 4))
-    return cam2world
-
-class Camera:
-    def __init__(self, h, w):
-        self.znear = 0.01
-        self.zfar = 1000
-        self.h = h
-        self.w = w
-        self.fovy = 20 / 180 * np.pi
-        self.position = np.array([0.0, 0.0, -5.6]).astype(np.float32)
-        self.target = np.array([0.0, 0.0, 0.0]).astype(np.float32)
-        self.up = -np.array([0.0, 1.0, 0.0]).astype(np.float32)
-        self.yaw = np.pi / 2
-        self.pitch = 0
-
-        self.is_pose_dirty = True
-        self.is_intrin_dirty = True
-
-        self.last_x = 640
-        self.last_y = 360
-        self.first_mouse = True
-
-        self.is_leftmouse_pressed = False
-        self.is_rightmouse_pressed = False
-
-        self.rot_sensitivity = -0.02
-        self.trans_sensitivity = -0.01
-        self.zoom_sensitivity = 0.08
-        self.roll_sensitivity = 0.03
-        self.target_dist = 3.
-    def _global_rot_mat(self):
-        x = np.array([1, 0, 0])
-        z = np.cross(x, self.up)
-        z = z / np.linalg.norm(z)
-        x = np.cross(self.up, z)
-        return np.stack([x, self.up, z], axis=-1)
-
-    def get_view_matrix(self):
-        target = torch.from_numpy(self.target).view(1,-1)
-        position  =torch.from_numpy(self.position).view(1,-1)
-        forward_vectors = normalize_vecs(target-position)
-        return create_cam2world_matrix(forward_vectors,position).inverse()[0]
-        # return np.array(glm.lookAt(self.position, self.target, self.up))
-
-    def get_project_matrix(self):
-        htanx, htany, focal = self.get_htanfovxy_focal()
-        f_n = self.zfar - self.znear
-        proj_mat = torch.Tensor([
-            1 / htanx, 0, 0, 0,
-            0, 1 / htany, 0, 0,
-            0, 0, self.zfar / f_n, - 2 * self.zfar * self.znear / f_n,
-            0, 0, 1, 0
-        ]).reshape(4,4).to(torch.float32)
-        # project_mat = glm.perspective(
-        #     self.fovy,
-        #     self.w / self.h,
-        #     self.znear,
-        #     self.zfar
-        # )
-        return proj_mat
-
-    def get_htanfovxy_focal(self):
-        htany = np.tan(self.fovy / 2)
-        htanx = htany / self.h * self.w
-        focal = self.h / (2 * htany)
-        return [htanx, htany, focal]
-
-    def get_focal(self):
-        return self.h / (2 * np.tan(self.fovy / 2))
-
-    def process_mouse(self, xpos, ypos):
-        if self.first_mouse:
-            self.last_x = xpos
-            self.last_y = ypos
-            self.first_mouse = False
-
-        xoffset = xpos - self.last_x
-        yoffset = self.last_y - ypos
-        self.last_x = xpos
-        self.last_y = ypos
-
-        if self.is_leftmouse_pressed:
-            self.yaw += xoffset * self.rot_sensitivity
-            self.pitch += yoffset * self.rot_sensitivity
-
-            self.pitch = np.clip(self.pitch, -np.pi / 2, np.pi / 2)
-
-            front = np.array([np.cos(self.yaw) * np.cos(self.pitch),
-                              np.sin(self.pitch), np.sin(self.yaw) *
-                              np.cos(self.pitch)])
-            front = self._global_rot_mat() @ front.reshape(3, 1)
-            front = front[:, 0]
-            self.position[:] = - front * np.linalg.norm(self.position - self.target) + self.target
-
-            self.is_pose_dirty = True
-
-        if self.is_rightmouse_pressed:
-            front = self.target - self.position
-            front = front / np.linalg.norm(front)
-            right = np.cross(self.up, front)
-            self.position += right * xoffset * self.trans_sensitivity
-            self.target += right * xoffset * self.trans_sensitivity
-            cam_up = np.cross(right, front)
-            self.position += cam_up * yoffset * self.trans_sensitivity
-            self.target += cam_up * yoffset * self.trans_sensitivity
-
-            self.is_pose_dirty = True
-
-    def process_wheel(self, dx, dy):
-        front = self.target - self.position
-        front = front / np.linalg.norm(front)
-        self.position += front * dy * self.zoom_sensitivity
-      #  self.target += front * dy * self.zoom_sensitivity
-        self.is_pose_dirty = True
-
-    def process_roll_key(self, d):
-        front = self.target - self.position
-        right = np.cross(front, self.up)
-        new_up = self.up + right * (d * self.roll_sensitivity / np.linalg.norm(right))
-        self.up = new_up / np.linalg.norm(new_up)
-        self.is_pose_dirty = True
-
-    def flip_ground(self):
-        self.up = -self.up
-        self.is_pose_dirty = True
-
-    def update_target_distance(self):
-        _dir = self.target - self.position
-        _dir = _dir / np.linalg.norm(_dir)
-        self.target = self.position + _dir * self.target_dist
-
-    def update_resolution(self, height, width):
-        self.h = max(height, 1)
-        self.w = max(width, 1)
-        self.is_intrin_dirty = True
-g_camera = Camera(512,512)
-def from_cam_to_GSCAM_dict(g_camera:Camera):
-    fovy = g_camera.fovy
-    fovx = g_camera.fovy
-    znear = g_camera.znear
-    zfar = g_camera.zfar
-    world_view_transform = g_camera.get_view_matrix()
-
-    proj_transform = g_camera.get_project_matrix()
-    full_proj_transform = proj_transform@world_view_transform
-
-    return [fovx,znear,zfar,world_view_transform,full_proj_transform]
+import copy
+import threading
+from RemoteRenderer import RemoteRenderer, FrameReceiver
+from protocol import pack_camera
+from camera import Camera, from_cam_to_GSCAM_dict
+from texture import StreamingTexture
+from protocol import codec_name
+from profiling import timer
+from reprojection import Reprojector
+from recording import ReplaySource
+
+g_camera = Camera(512,512) # the active viewport's camera, the one input moves
+g_input_events = 0 # counted by the callbacks, the render loop redraws when it changes
+def _input_event():
+    global g_input_events
+    g_input_events += 1
 def cursor_pos_callback(window, xpos, ypos):
+    _input_event()
     if imgui.get_io().want_capture_mouse:
         g_camera.is_leftmouse_pressed = False
         g_camera.is_rightmouse_pressed = False
     g_camera.process_mouse(xpos, ypos)
 
 def mouse_button_callback(window, button, action, mod):
+    _input_event()
     if imgui.get_io().want_capture_mouse:
         return
     pressed = action == glfw.PRESS
     g_camera.is_leftmouse_pressed = (button == glfw.MOUSE_BUTTON_LEFT and pressed)
     g_camera.is_rightmouse_pressed = (button == glfw.MOUSE_BUTTON_RIGHT and pressed)
 def wheel_callback(window, dx, dy):
+    _input_event()
     g_camera.process_wheel(dx, dy)
 def key_callback(window, key, scancode, action, mods):
+    _input_event()
     if action == glfw.REPEAT or action == glfw.PRESS:
         if key == glfw.KEY_Q:
             g_camera.process_roll_key(1)
@@ -236,12 +72,18 @@ def impl_glfw_init():
         glfw.terminate()
         print("Could not initialize Window")
         sys.exit(1)
+    glfw.swap_interval(1) # vsync paces the loop while it is drawing
 
     return window
 
 class Interface():
-    def __init__(self):
-        self.remote_renderer = RemoteRenderer()
+    def __init__(self, host="0.0.0.0", port=12345, replay=None, speed=1.0):
+        # replay: path of a recording to play back instead of listening for renderers
+        self.replay = ReplaySource(replay, speed=speed) if replay is not None else None
+        self.remote_renderer = self.replay or RemoteRenderer(host=host, port=port)
+        # the receiver thread wakes the render loop from glfw.wait_events_timeout
+        self._remote_changed = threading.Event()
+        self.receiver = FrameReceiver(self.remote_renderer, on_message=self._on_remote_message)
         window = impl_glfw_init()
         imgui.create_context()
         self.impl = GlfwRenderer(window)
@@ -250,79 +92,383 @@ class Interface():
         glfw.set_scroll_callback(window, wheel_callback)
         glfw.set_key_callback(window, key_callback)
         self.window = window
-        self.image_ids = []
-        self.initialize_state=[]
-       # self.create_empty_image()
-       # self.send_camera = False
-    def create_empty_image(self):
-        from OpenGL.GL import GL_TEXTURE_2D,glTexParameteri,GL_TEXTURE_MAG_FILTER,GL_TEXTURE_MIN_FILTER,GL_LINEAR
-        image_id = gl.glGenTextures(1)
-        self.textureData = None
-        self.initialize_state.append(False)
-        gl.glBindTexture(gl.GL_TEXTURE_2D,image_id)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-        self.image_ids.append(image_id)
+        self.textures = {} # (stream id, window id) -> StreamingTexture
+        self.camera_seq = 0
+        self.camera_targets = {} # stream id -> whether it gets our camera, all of them by default
+        # resolution negotiation: the renderer renders window 0's display size times the render scale,
+        # lowered to drag_scale while the camera is being dragged if dynamic_resolution is on
+        self.render_scale = 1.0
+        self.dynamic_resolution = True
+        self.drag_scale = 0.5
+        self.window_sizes = {} # stream id -> [(width, height)] of its windows
+        self._viewport_sizes = {} # viewport id -> (width, height) of the first window showing it
+        self.effective_scale = 1.0
+        # viewports: independently controlled cameras, e.g. a fixed reference next to a free view.
+        # All of them go to the renderer in one camera batch and every image says which one it shows.
+        self.viewports = [g_camera]
+        self.viewport_seqs = [0] # viewport id -> camera seq it last changed in
+        self.stereo = {} # viewport id -> viewport it is the right eye of
+        self.eye_separation = 0.06
+        self.window_viewports = {} # (stream id, window id) -> viewport the window shows
+        self._viewports_changed = False
+        # motion-to-photon: camera sent -> frame rendered with it on screen
+        self.motion_to_photon = deque(maxlen=120)
+        self._shown_camera_time = 0.0
+        self._answered_seqs = {} # stream id -> newest camera seq a frame was shown for
+        # idle handling: draw only after input, new frames or remote messages, otherwise every idle_timeout
+        self.idle_timeout = 0.5
+        self._redraw_frames = 1
+        self._last_draw = 0.0
+        self._framebuffer_size = None
+        # reprojection: until the frame rendered for the current camera arrives, the last frame of
+        # each window is warped toward it, with the depth the renderer sent if any
+        self.reprojection = True
+        self.sent_cameras = OrderedDict() # camera seq -> [(world_view, projection, distance to the target)] per viewport
+        # kept out of the buffer pool until the next frame of the window replaces it
+        self._frames = {} # (stream id, window id) -> (image, depth, camera seq, viewport, frame number) of the frame shown last
+        self._frame_number = 0
+        self._warped = {} # (stream id, window id) -> (world_view, projection) last warped toward
+        self.reprojector = Reprojector(on_done=self._on_remote_message)
+    def _on_remote_message(self):
+        # runs on the receiver thread
+        self._remote_changed.set()
+        glfw.post_empty_event()
     def process_remote(self):
-        remote_info = self.remote_renderer.read()
-        if remote_info['status']==0:
-            return False
-        if ("image" in remote_info):
-            images = remote_info["image"]
-            for i,img in enumerate(images):
-                self.set_image(img,i)
-            return True
-        if("send" in remote_info):
-            return False
+        # swap in the newest frame the receiver thread completed for each window
+        frames = self.receiver.take_latest()
+        unused = []
+        for i,(img,batch) in frames.items():
+            if not self.set_image(img,i):
+                unused.append(img)
+                continue
+            viewports = batch["viewports"]
+            self.window_viewports[i] = viewports[i[1]] if viewports and i[1] < len(viewports) else 0
+            if self.reprojection:
+                depth = batch["depth"].get(i[1])
+                if depth is not None and depth.shape != img.shape[:2]:
+                    depth = None
+                self.reprojector.cancel(i) # the warp of the replaced frame may still be reading it
+                if i in self._frames:
+                    unused.append(self._frames[i][0])
+                self._frame_number += 1
+                self._frames[i] = (img, depth, batch["camera_seq"], self.window_viewports[i], self._frame_number)
+                self._warped.pop(i, None)
+            else:
+                unused.append(img)
+            # a renderer repeats its last camera seq until the camera moves, only its first frame is a sample
+            if batch["camera_seq"] > self._answered_seqs.get(i[0], 0):
+                self._answered_seqs[i[0]] = batch["camera_seq"]
+                self._shown_camera_time = max(self._shown_camera_time, batch["camera_time"])
+        self.remote_renderer.recycle(unused)
+        closed = self.receiver.take_closed()
+        for stream_id in closed:
+            self.drop_stream(stream_id)
+        return len(frames) > 0 or len(closed) > 0
+    def drop_stream(self, stream_id):
+        # a renderer disconnected: its windows go, with their textures and the frames kept for them
+        for key in [key for key in self.textures if key[0] == stream_id]:
+            self.textures.pop(key).delete()
+        for key in [key for key in self._frames if key[0] == stream_id]:
+            self.reprojector.cancel(key)
+            self.remote_renderer.recycle([self._frames.pop(key)[0]])
+        for mapping in (self._warped, self.window_viewports):
+            for key in [key for key in mapping if key[0] == stream_id]:
+                del mapping[key]
+        for mapping in (self.window_sizes, self.camera_targets, self._answered_seqs):
+            mapping.pop(stream_id, None)
 
     def send_camera_to_remote(self):
-        gs_cam = from_cam_to_GSCAM_dict(g_camera)
-        pickle_bytes = pickle.dumps(gs_cam)
-        self.remote_renderer.send_cameras(pickle_bytes)
+        # a new seq when a viewport changed, every stream gets the newest cameras once it can take them
+        self.sync_stereo()
+        dirty = [v for v, camera in enumerate(self.viewports) if camera.is_pose_dirty or camera.is_intrin_dirty]
+        if dirty or self._viewports_changed:
+            self.camera_seq += 1
+            self._viewports_changed = False
+            for v in dirty:
+                self.viewports[v].is_pose_dirty = False
+                self.viewports[v].is_intrin_dirty = False
+                self.viewport_seqs[v] = self.camera_seq
+            self.sent_cameras[self.camera_seq] = [(camera.get_view_matrix().copy(), camera.get_project_matrix().copy(),
+                                                   float(np.linalg.norm(camera.target - camera.position)))
+                                                  for camera in self.viewports]
+            while len(self.sent_cameras) > 64:
+                self.sent_cameras.popitem(last=False)
+        for stream in self.remote_renderer.stream_list():
+            if not (stream.can_send and self.camera_targets.get(stream.id, True)):
+                continue
+            if stream.sent_seq == self.camera_seq and not stream.camera_requested:
+                continue # the renderer keeps using the last camera it got
+            if not stream.can_request_camera():
+                continue # goes out once an earlier camera is answered
+            if len(self.viewports) == 1:
+                stream.send_camera(self.pack_viewport_camera(0, stream.id), self.camera_seq)
+                continue
+            # only the viewports this renderer has an older camera of
+            changed = [v for v, seq in enumerate(self.viewport_seqs)
+                       if stream.camera_requested or stream.viewport_seqs.get(v, 0) < seq]
+            stream.send_camera_batch(len(self.viewports), [(v, self.pack_viewport_camera(v, stream.id)) for v in changed],
+                                     self.camera_seq)
+    def pack_viewport_camera(self, viewport, stream_id):
+        camera = self.viewports[viewport]
+        width = max(int(round(camera.w * self.effective_scale)), 1)
+        height = max(int(round(camera.h * self.effective_scale)), 1)
+        window_sizes = [size for i, size in enumerate(self.window_sizes.get(stream_id, []))
+                        if self.window_viewports.get((stream_id, i), 0) == viewport]
+        return pack_camera(self.camera_seq, *from_cam_to_GSCAM_dict(camera), fovy=camera.fovy,
+                           width=width, height=height, render_scale=self.effective_scale,
+                           window_sizes=window_sizes, timestamp=time())
+    def set_active_viewport(self, viewport):
+        # input moves the active viewport's camera
+        global g_camera
+        g_camera.is_leftmouse_pressed = False
+        g_camera.is_rightmouse_pressed = False
+        g_camera = self.viewports[viewport]
+    def add_viewport(self, stereo=False):
+        # a copy of the active camera, or its right eye that follows it
+        active = self.viewports.index(g_camera)
+        camera = copy.deepcopy(g_camera)
+        camera.is_leftmouse_pressed = False
+        camera.is_rightmouse_pressed = False
+        camera.is_pose_dirty = True
+        self.viewports.append(camera)
+        self.viewport_seqs.append(0)
+        if stereo:
+            self.stereo[len(self.viewports) - 1] = self.stereo.get(active, active)
+        self._viewports_changed = True
+    def remove_viewport(self):
+        # the last one, viewport 0 always stays
+        if len(self.viewports) < 2:
+            return
+        removed = len(self.viewports) - 1
+        if g_camera is self.viewports[removed]:
+            self.set_active_viewport(0)
+        self.viewports.pop()
+        self.viewport_seqs.pop()
+        self.stereo = {v: leader for v, leader in self.stereo.items() if removed not in (v, leader)}
+        self._viewports_changed = True
+    def sync_stereo(self):
+        # a right eye is its leader's camera moved sideways by the eye separation
+        for v, leader in self.stereo.items():
+            src, eye = self.viewports[leader], self.viewports[v]
+            right = np.cross(src.target - src.position, src.up)
+            offset = (right / np.linalg.norm(right) * self.eye_separation).astype(np.float32)
+            position, target = src.position + offset, src.target + offset
+            if not (np.array_equal(position, eye.position) and np.array_equal(target, eye.target)
+                    and np.array_equal(src.up, eye.up)):
+                eye.position, eye.target, eye.up = position, target, src.up.copy()
+                eye.is_pose_dirty = True
+            if eye.fovy != src.fovy:
+                eye.fovy = src.fovy
+                eye.is_intrin_dirty = True
+    def reproject_frames(self):
+        # show the last frame of every window as the current camera of its viewport would see it,
+        # the warps run on the reprojector's thread and show up a redraw later
+        for key, (number, warped) in self.reprojector.take_results().items():
+            if key in self._frames and self._frames[key][4] == number: # not replaced by a rendered frame meanwhile
+                self.set_image(warped, key)
+        for key, (image, depth, seq, viewport, number) in self._frames.items():
+            if not self.camera_targets.get(key[0], True) or seq not in self.sent_cameras:
+                continue # that stream doesn't follow our camera, or we don't know the one it rendered with
+            if viewport >= len(self.viewports) or viewport >= len(self.sent_cameras[seq]):
+                continue
+            view, proj = self.viewports[viewport].get_view_matrix(), self.viewports[viewport].get_project_matrix()
+            src_view, src_proj, distance = self.sent_cameras[seq][viewport]
+            shown_view, shown_proj = self._warped.get(key, (src_view, src_proj))
+            if np.array_equal(view, shown_view) and np.array_equal(proj, shown_proj):
+                continue
+            self.reprojector.submit(key, number, image, src_view, src_proj, view.copy(), proj.copy(),
+                                    depth=depth, plane_depth=distance)
+            self._warped[key] = (view.copy(), proj.copy())
+    def clear_frames(self):
+        # stops reprojection of the kept frames and returns them to the pool
+        for key in self._frames:
+            self.reprojector.cancel(key)
+        self.remote_renderer.recycle(frame[0] for frame in self._frames.values())
+        self._frames.clear()
+        self._warped.clear()
+    def update_render_size(self, window_sizes):
+        dragging = g_camera.is_leftmouse_pressed or g_camera.is_rightmouse_pressed
+        scale = self.drag_scale if self.dynamic_resolution and dragging else self.render_scale
+        # the camera of a viewport follows the first window showing it, first stream first
+        viewport_sizes = {}
+        for stream_id in sorted(window_sizes):
+            for i, size in enumerate(window_sizes[stream_id]):
+                viewport_sizes.setdefault(self.window_viewports.get((stream_id, i), 0), size)
+        if window_sizes != self.window_sizes or viewport_sizes != self._viewport_sizes or scale != self.effective_scale:
+            self.window_sizes = window_sizes
+            self._viewport_sizes = viewport_sizes
+            self.effective_scale = scale
+            for v, camera in enumerate(self.viewports):
+                if v in viewport_sizes:
+                    width, height = viewport_sizes[v]
+                    camera.update_resolution(height, width)
+                camera.is_intrin_dirty = True
     def run(self):
+        global g_input_events
         print("run")
-
+        self.receiver.start()
         while not glfw.window_should_close(self.window):
-
-            glfw.poll_events()
-            self.impl.process_inputs()
-            imgui.new_frame()
-            imgui.begin("control panel")
-            isread = imgui.button("read remote")
-            if isread:
-                self.remote_renderer.can_read = True
-            imgui.end()
-            if self.remote_renderer.can_read:
-          
-                self.process_remote()
-            for i in range(len(self.initialize_state)):
-                if self.initialize_state[i]:
-                    imgui.begin(f"window {i}")
-                    imgui.image(self.image_ids[i], 512, 512)
-                    imgui.end()
-            if(self.remote_renderer.can_send):
-                self.send_camera_to_remote()
-            gl.glClearColor(1.0, 1.0, 1.0, 1)
-            gl.glClear(gl.GL_COLOR_BUFFER_BIT)
-            imgui.render()
-            self.impl.render(imgui.get_draw_data())
-            glfw.swap_buffers(self.window)
-
-           # self.update()
+            # sleep in the event queue while nothing happens, input and new frames wake us up
+            if self._redraw_frames > 0:
+                glfw.poll_events()
+            else:
+                glfw.wait_events_timeout(self.idle_timeout)
+            framebuffer_size = glfw.get_framebuffer_size(self.window)
+            if g_input_events or framebuffer_size != self._framebuffer_size:
+                g_input_events = 0
+                self._framebuffer_size = framebuffer_size
+                self._redraw_frames = 3 # imgui needs a few frames to settle hover and active states
+            if self._remote_changed.is_set():
+                self._remote_changed.clear()
+                self._redraw_frames = max(self._redraw_frames, 1)
+            if self.process_remote() or time() - self._last_draw > self.idle_timeout:
+                self._redraw_frames = max(self._redraw_frames, 1)
+            if self._redraw_frames > 0:
+                self._redraw_frames -= 1
+                if self.reprojection:
+                    self.reproject_frames()
+                self.draw_frame()
+            self.send_camera_to_remote()
+
+        self.receiver.stop()
+        self.reprojector.stop()
         self.impl.shutdown()
         glfw.terminate()
-        self.remote_renderer.socker.close()
+        self.remote_renderer.close()
+    def draw_frame(self):
+        self.impl.process_inputs()
+        imgui.new_frame()
+        imgui.begin("control panel")
+        isread = imgui.button("read remote")
+        if isread:
+            self.remote_renderer.resume_reading()
+        for stream in self.remote_renderer.stream_list():
+            imgui.separator()
+            imgui.text(f"stream {stream.id}: {stream.addr[0]}:{stream.addr[1]}")
+            _, self.camera_targets[stream.id] = imgui.checkbox(f"send camera##{stream.id}",
+                                                               self.camera_targets.get(stream.id, True))
+            quality = stream.quality
+            if quality is not None:
+                imgui.text(f"quality {quality['level']}: {codec_name(quality['codec'])}, "
+                           f"{quality['bits']} bits, 1/{quality['scale']} size")
+                imgui.text(f"{quality['fps']:.0f} fps, rtt {quality['rtt_ms']:.1f} ms, {quality['mbps']:.1f} MB/s")
+            if stream.frames_discarded:
+                imgui.text(f"{stream.frames_discarded} stale frames discarded")
+        imgui.separator()
+        if self.motion_to_photon:
+            imgui.text(f"motion-to-photon {np.median(self.motion_to_photon) * 1e3:.0f} ms")
+        _, self.render_scale = imgui.slider_float("render scale", self.render_scale, 0.1, 2.0)
+        _, self.dynamic_resolution = imgui.checkbox("lower resolution while dragging", self.dynamic_resolution)
+        changed, self.reprojection = imgui.checkbox("reproject while waiting for frames", self.reprojection)
+        if changed and not self.reprojection:
+            self.clear_frames()
+        imgui.separator()
+        for v, camera in enumerate(self.viewports):
+            label = f"viewport {v}" + (f" (right eye of {self.stereo[v]})" if v in self.stereo else "")
+            if imgui.radio_button(label, camera is g_camera):
+                self.set_active_viewport(v)
+        if imgui.button("add viewport"):
+            self.add_viewport()
+        imgui.same_line()
+        if imgui.button("add stereo eye"):
+            self.add_viewport(stereo=True)
+        if len(self.viewports) > 1:
+            imgui.same_line()
+            if imgui.button("remove viewport"):
+                self.remove_viewport()
+        if self.stereo:
+            _, self.eye_separation = imgui.slider_float("eye separation", self.eye_separation, 0.0, 1.0)
+        imgui.end()
+        self.stats_panel()
+        if self.replay is not None:
+            self.replay_panel()
+        window_sizes = {}
+        for (stream_id, i), texture in sorted(self.textures.items()):
+            imgui.set_next_window_size(528, 548, imgui.FIRST_USE_EVER)
+            title = f"stream {stream_id} window {i}"
+            if len(self.viewports) > 1: # the id after ### keeps the window when its viewport changes
+                title = f"{title} - viewport {self.window_viewports.get((stream_id, i), 0)}###{title}"
+            imgui.begin(title)
+            width, height = imgui.get_content_region_available()
+            width, height = max(int(width), 1), max(int(height), 1)
+            window_sizes.setdefault(stream_id, []).append((width, height))
+            # keep the aspect ratio of the frame, it may not match the window until the next render
+            image_height, image_width = texture.shape[:2]
+            fit = min(width / image_width, height / image_height)
+            imgui.image(texture.texture_id, image_width * fit, image_height * fit)
+            imgui.end()
+        self.update_render_size(window_sizes)
+        gl.glClearColor(1.0, 1.0, 1.0, 1)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+        imgui.render()
+        self.impl.render(imgui.get_draw_data())
+        glfw.swap_buffers(self.window)
+        if self._shown_camera_time:
+            self.motion_to_photon.append(time() - self._shown_camera_time)
+            self._shown_camera_time = 0.0
+        self._last_draw = time()
+    def replay_panel(self):
+        replay = self.replay
+        imgui.begin("replay")
+        duration = replay.recording.duration()
+        imgui.text(f"frame {replay.frame + 1} / {len(replay.recording)}")
+        changed, seconds = imgui.slider_float("time", min(replay.play_time(), duration), 0.0, duration, "%.2f s")
+        if changed: # scrubbing
+            replay.seek(seconds)
+        if imgui.button("play" if replay.paused else "pause"):
+            replay.pause(not replay.paused)
+        imgui.same_line()
+        if imgui.button("<"):
+            replay.step(-1)
+        imgui.same_line()
+        if imgui.button(">"):
+            replay.step(1)
+        changed, speed = imgui.slider_float("speed", replay.speed, 0.1, 16.0, "%.1fx")
+        if changed:
+            replay.set_speed(speed)
+        _, replay.loop = imgui.checkbox("loop", replay.loop)
+        imgui.end()
+        if not replay.paused:
+            self._redraw_frames = max(self._redraw_frames, 1) # the time slider moves
+    def stats_panel(self):
+        imgui.begin("stats")
+        _, enabled = imgui.checkbox("time stages", timer.enabled)
+        timer.enable(enabled)
+        if imgui.button("export trace"):
+            path = strftime("trace_%Y%m%d_%H%M%S.json")
+            print(f"{timer.export_chrome_trace(path)} events written to {path}")
+        imgui.same_line()
+        if imgui.button("reset"):
+            timer.reset()
+        if timer.durations:
+            imgui.columns(5)
+            for text in ("stage", "n", "p50 ms", "p90 ms", "p99 ms"):
+                imgui.text(text)
+                imgui.next_column()
+            for name, (samples, percentiles) in sorted(timer.percentiles().items()):
+                imgui.text(name)
+                imgui.next_column()
+                imgui.text(str(samples))
+                imgui.next_column()
+                for value in percentiles:
+                    imgui.text(f"{value * 1e3:.2f}")
+                    imgui.next_column()
+            imgui.columns(1)
+        imgui.end()
     def set_image(self,image,window_id):
-        if isinstance(image,np.ndarray):
-            # image = image * 255.
-            width,height = image.shape[-2],image.shape[-3]
-        textureData = image
-        if window_id<len(self.image_ids):
-            gl.glBindTexture(gl.GL_TEXTURE_2D,self.image_ids[window_id])
-        else:
-            self.create_empty_image()
-        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, width, height, 0, gl.GL_RGB,gl.GL_UNSIGNED_BYTE, textureData)
-        self.initialize_state[window_id]=True
+        # window_id: (stream id, window index), texture storage is only reallocated when the image size changes
+        # returns False for a frame that can't be shown, the window keeps its last one
+        if window_id not in self.textures:
+            self.textures[window_id] = StreamingTexture()
+        try:
+            with timer.stage("upload"):
+                self.textures[window_id].upload(image)
+        except ValueError as e: # one renderer sending something odd must not close the viewer
+            print(f"stream {window_id[0]} window {window_id[1]}: frame skipped, {e}")
+            if self.textures[window_id].shape is None: # nothing shown in it yet
+                self.textures.pop(window_id).delete()
+            return False
+        return True
     def get_view_matrix(self):
         return g_camera.get_view_matrix()
 
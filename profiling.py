@@ -0,0 +1,104 @@
+#
+# Per-stage timing for the streaming path.
+#
+#   from profiling import timer
+#   timer.enable()
+#   with timer.stage("render"):
+#       ...
+#   timer.instant("step", step=iteration) # shows up as a marker in the trace
+#   timer.export_chrome_trace("trace.json") # open in chrome://tracing or ui.perfetto.dev
+#
+# Disabled (the default) a stage costs one attribute check. Trace timestamps
+# are wall clock, so traces of the renderer and the viewer process line up.
+#
+
+import json
+import os
+import threading
+import time
+from collections import deque
+import numpy as np
+
+class _Stage():
+    __slots__ = ("timer", "name", "begin")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, self.begin, time.perf_counter())
+
+class _NullStage():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return None
+
+_null_stage = _NullStage()
+
+class StageTimer():
+    def __init__(self, window=256, max_events=200000):
+        self.enabled = False
+        self.window = window # durations kept per stage for the rolling percentiles
+        self.durations = {}
+        self.events = deque(maxlen=max_events) # for the trace, oldest events go first
+        self._offset = time.time() - time.perf_counter() # perf_counter -> wall clock
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def stage(self, name):
+        if not self.enabled:
+            return _null_stage
+        return _Stage(self, name)
+
+    def record(self, name, begin, end):
+        durations = self.durations.get(name)
+        if durations is None:
+            durations = self.durations.setdefault(name, deque(maxlen=self.window))
+        durations.append(end - begin)
+        self.events.append(("X", name, begin, end - begin, threading.get_ident(), None))
+
+    def instant(self, name, **args):
+        if self.enabled:
+            self.events.append(("i", name, time.perf_counter(), 0.0, threading.get_ident(), args))
+
+    def percentiles(self, q=(50, 90, 99)):
+        """{stage: (samples, [percentiles in seconds])} over the last `window` samples of every stage."""
+        stats = {}
+        for name, durations in list(self.durations.items()):
+            samples = list(durations)
+            if samples:
+                stats[name] = (len(samples), np.percentile(samples, q).tolist())
+        return stats
+
+    def reset(self):
+        self.durations.clear()
+        self.events.clear()
+
+    def export_chrome_trace(self, path):
+        pid = os.getpid()
+        trace = []
+        for phase, name, begin, duration, tid, args in list(self.events):
+            event = {"name": name, "ph": phase, "ts": (begin + self._offset) * 1e6, "pid": pid, "tid": tid}
+            if phase == "X":
+                event["dur"] = duration * 1e6
+            else:
+                event["s"] = "p" # instant events span the whole process
+            if args:
+                event["args"] = args
+            trace.append(event)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+        return len(trace)
+
+# one per process, shared by RemoteViewer, RemoteRenderer and the interface
+timer = StageTimer()
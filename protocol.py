@@ -0,0 +1,355 @@
+#
+# Wire format shared by RemoteViewer (sender) and RemoteRenderer (receiver).
+#
+# Every image is sent as a fixed-size frame header followed by the payload:
+#   magic | version | codec | flags | ndim | dtype | shape[4] | raw size | payload size
+# The payload is the raw C-contiguous pixel buffer, optionally compressed by
+# the codec named in the header. Nothing on the wire is ever unpickled.
+#
+
+import socket
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+import numpy as np
+
+def b2i(b):
+    return int.from_bytes(b, 'little')
+def i2b(i):
+    return int(i).to_bytes(4,"little")
+
+FRAME_MAGIC = b"RVF"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<3sBBBB4s4IQQ")
+MAX_NDIM = 4
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+CODEC_SHM = 255 # payload is a reference into a shared memory ring (shm_transport), not a codec you can pick
+
+FLAG_DELTA = 1    # payload holds changed tiles only, see delta.py
+FLAG_KEYFRAME = 2 # full frame that following delta frames of the same window patch
+FLAG_DEPTH = 4    # view space depth of the image frame right before it, not a window of its own
+
+_codecs = {}     # id -> (name, compress, decompress)
+_codec_ids = {}  # name -> id
+
+def register_codec(codec_id, name, compress, decompress):
+    """Make a codec available on this end. Both ends must register the same id.
+
+    `compress` takes a bytes-like object and returns bytes, `decompress` does the reverse.
+    If `compress` accepts a `level` keyword, the sender may pick a compression level per frame.
+    """
+    if not 0 <= codec_id < 256:
+        raise ValueError(f"codec id must fit in one byte, got {codec_id}")
+    _codecs[codec_id] = (name, compress, decompress)
+    _codec_ids[name] = codec_id
+
+def codec_id(codec):
+    if isinstance(codec, str):
+        if codec not in _codec_ids:
+            raise ValueError(f"unknown codec {codec!r}, available: {sorted(_codec_ids)}")
+        return _codec_ids[codec]
+    if codec not in _codecs:
+        raise ValueError(f"unknown codec id {codec}")
+    return codec
+
+def codec_name(codec):
+    return _codecs[codec_id(codec)][0]
+
+def available_codecs():
+    return sorted(_codec_ids)
+
+register_codec(CODEC_NONE, "none", None, None)
+# level 1 deflate: most of the ratio of level 9 at a fraction of the cost
+register_codec(CODEC_ZLIB, "zlib", lambda data, level=1: zlib.compress(data, level), zlib.decompress)
+try:
+    import lz4.frame
+    register_codec(CODEC_LZ4, "lz4", lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+def frame_header(image, cid, payload_nbytes, flags=0, raw_nbytes=None):
+    """Header of a frame carrying `image` (a C-contiguous array).
+    raw_nbytes is the size of the payload before compression, the image size by default."""
+    if image.dtype.hasobject:
+        raise ValueError("object arrays can not be sent")
+    if image.ndim > MAX_NDIM:
+        raise ValueError(f"at most {MAX_NDIM} dimensions are supported, got {image.ndim}")
+    dtype = image.dtype.str.encode()
+    if len(dtype) > 4:
+        raise ValueError(f"unsupported dtype {image.dtype}")
+    shape = tuple(image.shape) + (0,) * (MAX_NDIM - image.ndim)
+    raw_nbytes = image.nbytes if raw_nbytes is None else raw_nbytes
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, cid, flags, image.ndim,
+                             dtype, *shape, raw_nbytes, payload_nbytes)
+
+def compress_payload(raw, cid, level=None):
+    compress = _codecs[cid][1]
+    if compress is None:
+        return raw
+    return compress(raw) if level is None else compress(raw, level=level)
+
+def encode_frame(image, codec=CODEC_ZLIB, flags=0, level=None):
+    """Returns (header bytes, payload). The payload may be a view of `image`."""
+    image = np.ascontiguousarray(image)
+    cid = codec_id(codec)
+    payload = compress_payload(memoryview(image).cast("B"), cid, level)
+    return frame_header(image, cid, len(payload), flags), payload
+
+def parse_frame_header(header):
+    """Returns a dict describing the frame, raises ValueError on a malformed header."""
+    magic, version, cid, flags, ndim, dtype, *rest = FRAME_HEADER.unpack(header)
+    shape, raw_nbytes, payload_nbytes = rest[:MAX_NDIM], rest[MAX_NDIM], rest[MAX_NDIM + 1]
+    if magic != FRAME_MAGIC:
+        raise ValueError("bad frame magic")
+    if version != FRAME_VERSION:
+        raise ValueError(f"unsupported frame version {version}")
+    if cid not in _codecs and cid != CODEC_SHM:
+        raise ValueError(f"frame uses unknown codec id {cid}")
+    if ndim > MAX_NDIM:
+        raise ValueError(f"bad frame ndim {ndim}")
+    dtype = np.dtype(dtype.rstrip(b"\0").decode())
+    if dtype.hasobject:
+        raise ValueError("object arrays can not be received")
+    shape = tuple(shape[:ndim])
+    if not flags & FLAG_DELTA and int(np.prod(shape)) * dtype.itemsize != raw_nbytes:
+        raise ValueError("frame size does not match its shape")
+    return {"codec": cid, "flags": flags, "dtype": dtype, "shape": shape,
+            "raw_nbytes": raw_nbytes, "payload_nbytes": payload_nbytes}
+
+# Image batch, renderer -> viewer, sent after head 1:
+#   num | seq of the camera the images were rendered with (0: none) | that camera's timestamp | send time
+#   | number of viewport ids
+# followed by the viewport id (VIEWPORT) of every image, or none if they all show viewport 0, then `num` frames.
+BATCH_HEADER = struct.Struct("<IQddH")
+
+# Camera message, viewer -> renderer, sent after head 0 and only when the camera changed:
+#   seq | timestamp (viewer clock, echoed in the batch rendered with it) | fovx | fovy | znear | zfar | world_view (4x4, row major) | full_proj (4x4, row major)
+#   | render width | render height | render scale | number of windows
+# followed by the display size (WINDOW_SIZE) of each image window. The render size is the
+# size of the first window times the render scale, 0 x 0 if the viewer has no preference.
+CAMERA_MESSAGE = struct.Struct("<Qd4f16f16fHHfH")
+WINDOW_SIZE = struct.Struct("<HH") # width, height
+
+# Camera batch, viewer -> renderer, sent after head 4 instead of a camera when the viewer has several viewports:
+#   number of viewports | number of cameras
+# followed by the viewport id (VIEWPORT), camera message and window sizes of each camera. Only viewports
+# whose camera changed are in it, all with the same seq; the renderer keeps the last camera of the others.
+CAMERA_BATCH = struct.Struct("<HH")
+VIEWPORT = struct.Struct("<H")
+
+def pack_camera(seq, fovx, znear, zfar, world_view_transform, full_proj_transform,
+                fovy=None, width=0, height=0, render_scale=1.0, window_sizes=(), timestamp=0.0):
+    world_view = np.asarray(world_view_transform, dtype=np.float32).reshape(16)
+    full_proj = np.asarray(full_proj_transform, dtype=np.float32).reshape(16)
+    fovy = fovx if fovy is None else fovy
+    message = CAMERA_MESSAGE.pack(seq, timestamp, fovx, fovy, znear, zfar, *world_view, *full_proj,
+                                  width, height, render_scale, len(window_sizes))
+    return message + b"".join(WINDOW_SIZE.pack(w, h) for w, h in window_sizes)
+
+def unpack_camera(data):
+    seq, timestamp, fovx, fovy, znear, zfar, *rest = CAMERA_MESSAGE.unpack(data)
+    matrices = np.array(rest[:32], dtype=np.float32).reshape(2, 4, 4)
+    width, height, render_scale, num_windows = rest[32:]
+    return {"seq": seq, "timestamp": timestamp, "fovx": fovx, "fovy": fovy, "znear": znear, "zfar": zfar,
+            "world_view_transform": matrices[0], "full_proj_transform": matrices[1],
+            "width": width, "height": height, "render_scale": render_scale, "num_windows": num_windows}
+
+def unpack_window_sizes(data):
+    return [size for size in WINDOW_SIZE.iter_unpack(data)]
+
+def pack_camera_batch(num_viewports, cameras):
+    """cameras: [(viewport id, pack_camera(...))]"""
+    return CAMERA_BATCH.pack(num_viewports, len(cameras)) + b"".join(VIEWPORT.pack(v) + m for v, m in cameras)
+
+def pack_viewport_ids(viewports):
+    return struct.pack(f"<{len(viewports)}H", *viewports)
+
+def unpack_viewport_ids(data):
+    return list(struct.unpack(f"<{len(data) // VIEWPORT.size}H", data))
+
+def decode_frame(info, payload):
+    """Rebuilds the array. With codec none the result is a view of `payload`."""
+    return np.frombuffer(decode_payload(info, payload), dtype=info["dtype"]).reshape(info["shape"])
+
+def decode_payload(info, payload):
+    """Undoes the codec, the result is `payload` itself for codec none."""
+    if info["codec"] == CODEC_SHM:
+        raise ValueError("shared memory frames are decoded by their ShmRing")
+    decompress = _codecs[info["codec"]][2]
+    raw = payload if decompress is None else decompress(payload)
+    if len(raw) != info["raw_nbytes"]:
+        raise ValueError("decoded frame has the wrong size")
+    return raw
+
+class BufferPool:
+    """Reusable receive buffers keyed by their size.
+
+    Frames of a stream nearly always have the same size, so after the first
+    few messages every receive lands in an already allocated bytearray.
+    """
+    def __init__(self, max_per_size=4, max_sizes=8):
+        self.max_per_size = max_per_size
+        self.max_sizes = max_sizes
+        self._free = OrderedDict() # size -> [bytearray], least recently used first
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes):
+        with self._lock:
+            free = self._free.get(nbytes)
+            if free:
+                self._free.move_to_end(nbytes)
+                return free.pop()
+        return bytearray(nbytes)
+
+    def release(self, buf):
+        if not isinstance(buf, bytearray):
+            return
+        with self._lock:
+            free = self._free.setdefault(len(buf), [])
+            self._free.move_to_end(len(buf))
+            if len(free) < self.max_per_size:
+                free.append(buf)
+            while len(self._free) > self.max_sizes:
+                self._free.popitem(last=False)
+
+    def release_array(self, array):
+        """Gives back the buffer an array decoded by decode_frame is a view of."""
+        base = array
+        while base is not None and not isinstance(base, bytearray):
+            base = getattr(base, "base", None) if not isinstance(base, memoryview) else base.obj
+        self.release(base)
+
+IOV_MAX = 1024 # buffers per sendmsg call, the POSIX minimum is 16 but every system we run on allows 1024
+
+def send_buffers(sock, buffers):
+    """Sends a list of bytes-like objects with a single scatter-gather sendmsg
+    per kernel write instead of concatenating them or calling sendall on each."""
+    if not hasattr(sock, "sendmsg"): # windows
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    views = [memoryview(buf).cast("B") for buf in buffers if len(buf)]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + IOV_MAX])
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:] # partial write, resume inside this buffer
+
+def recv_into_exact(sock, buf):
+    view = memoryview(buf)
+    pos, total = 0, len(view)
+    while pos < total:
+        n = sock.recv_into(view[pos:], total - pos)
+        if n == 0:
+            raise ConnectionError("connection closed by peer")
+        pos += n
+    return buf
+
+def recv_exact(sock, nbytes):
+    return recv_into_exact(sock, bytearray(nbytes))
+
+# Incremental parsing, for a server that reads many sockets from one thread.
+# A parser is a generator that yields the buffer it wants filled next and
+# finds it filled when it resumes, so `data = yield from take(n)` reads like
+# recv_exact but never blocks.
+
+def take(nbytes, pool=None):
+    buf = pool.acquire(nbytes) if pool is not None else bytearray(nbytes)
+    yield buf
+    return buf
+
+_DONTWAIT = getattr(socket, "MSG_DONTWAIT", None) # not on windows, there feed() does one recv per call
+
+class IncrementalReader:
+    """Feeds what a socket has to a parser generator."""
+    def __init__(self, parser, max_recv=4 << 20):
+        self.parser = parser
+        self.max_recv = max_recv # bytes per feed(), a fast peer can't keep the thread from the others
+        self._advance(next(parser))
+
+    def _advance(self, buf):
+        while True:
+            self.view = memoryview(buf).cast("B")
+            self.filled = 0
+            if len(self.view):
+                return
+            buf = self.parser.send(None) # nothing to read for this step
+
+    def feed(self, sock):
+        """Call when `sock` is readable, reads what it has up to max_recv bytes.
+        Returns False once the peer closed the connection."""
+        received = 0
+        flags = 0 # the selector said there is data, the first recv won't block
+        while received < self.max_recv:
+            try:
+                n = sock.recv_into(self.view[self.filled:], min(len(self.view) - self.filled, self.max_recv), flags)
+            except BlockingIOError:
+                return True
+            if n == 0:
+                return False
+            received += n
+            self.filled += n
+            if self.filled == len(self.view):
+                self._advance(self.parser.send(None))
+            if _DONTWAIT is None:
+                return True
+            flags = _DONTWAIT
+        return True
+
+    def feed_buffer(self, data):
+        """Like feed() for bytes already in memory, e.g. a record of a recording."""
+        data = memoryview(data).cast("B")
+        pos = 0
+        while pos < len(data):
+            n = min(len(self.view) - self.filled, len(data) - pos)
+            self.view[self.filled:self.filled + n] = data[pos:pos + n]
+            pos += n
+            self.filled += n
+            if self.filled == len(self.view):
+                self._advance(self.parser.send(None))
+
+class LatestMailbox:
+    """Bounded hand-off between threads that keeps the newest items.
+
+    put() never blocks: when the mailbox is full the oldest item is evicted
+    and returned so the caller can count or recycle it.
+    """
+    def __init__(self, size=1):
+        self.size = size
+        self._items = []
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, item):
+        with self._cond:
+            dropped = self._items.pop(0) if len(self._items) >= self.size else None
+            self._items.append(item)
+            self._cond.notify()
+        return dropped
+
+    def get(self, timeout=None):
+        """Returns the oldest pending item, or None on timeout or close."""
+        with self._cond:
+            if timeout is None:
+                while not self._items and not self._closed:
+                    self._cond.wait()
+            elif not self._items and not self._closed:
+                self._cond.wait(timeout)
+            return self._items.pop(0) if self._items else None
+
+    def drain(self):
+        with self._cond:
+            items, self._items = self._items, []
+        return items
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
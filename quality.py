@@ -0,0 +1,102 @@
+#
+# Adaptive stream quality for RemoteViewer.
+#
+# The controller walks a ladder of settings, from raw pixels (fast LAN) down to
+# compressed, quantized and downscaled frames (slow links), using what the
+# sender measures for every frame: encode time, bytes, time spent in the
+# socket, and the round trip time of the quality reports the viewer echoes.
+#
+
+import struct
+import numpy as np
+from protocol import available_codecs, codec_id
+
+# renderer -> viewer (head 6): timestamp to echo | level | codec | bits | scale | fps | rtt ms | MB/s
+QUALITY_REPORT = struct.Struct("<dBBBBfff")
+# viewer -> renderer (head 3): the timestamp of the report
+QUALITY_ECHO = struct.Struct("<d")
+
+def default_ladder():
+    fast = "lz4" if "lz4" in available_codecs() else "zlib"
+    return [ # (codec, compression level, bits per channel, downscale factor), best quality first
+        ("none", None, 8, 1),
+        (fast, None, 8, 1),
+        ("zlib", 1, 8, 1),
+        ("zlib", 6, 8, 1),
+        ("zlib", 6, 6, 1),
+        ("zlib", 6, 6, 2),
+        ("zlib", 6, 5, 4),
+    ]
+
+def apply_quality(image, bits, scale):
+    """Downscales by striding and drops the low bits of 8-bit images, both make frames compress better."""
+    if scale > 1 and image.ndim >= 2:
+        image = image[::scale, ::scale]
+    if bits < 8 and image.dtype == np.uint8:
+        image = image & np.uint8((0xFF << (8 - bits)) & 0xFF)
+    return image
+
+class QualityController():
+    def __init__(self, target_fps=30, latency_budget=None, ladder=None, start_level=2,
+                 down_after=3, up_after=30, smoothing=0.2):
+        self.frame_budget = 1.0 / target_fps
+        self.latency_budget = latency_budget if latency_budget is not None else 4 * self.frame_budget
+        self.ladder = ladder or default_ladder()
+        self.level = min(start_level, len(self.ladder) - 1)
+        self.down_after = down_after # consecutive frames over budget before lowering quality
+        self.up_after = up_after     # consecutive frames well under budget before raising it
+        self.smoothing = smoothing
+        self.encode_time = 0.0
+        self.frame_bytes = 0.0
+        self.throughput = None # bytes per second through the socket
+        self.rtt = None
+        self._over = 0
+        self._under = 0
+
+    def current(self):
+        codec, level, bits, scale = self.ladder[self.level]
+        return {"level": self.level, "codec": codec_id(codec), "codec_level": level, "bits": bits, "scale": scale}
+
+    def _ewma(self, old, new):
+        return new if old is None else old + self.smoothing * (new - old)
+
+    def observe_rtt(self, rtt):
+        self.rtt = self._ewma(self.rtt, rtt)
+
+    def frame_time(self):
+        # what a frame costs end to end at the current setting
+        link = self.frame_bytes / self.throughput if self.throughput else 0.0
+        return self.encode_time + link
+
+    def observe_frame(self, encode_time, nbytes, send_time):
+        """Feeds the measurements of one sent batch, returns True if the setting changed."""
+        self.encode_time = self._ewma(self.encode_time, encode_time)
+        self.frame_bytes = self._ewma(self.frame_bytes, nbytes)
+        if send_time > 1e-4: # a send that fits in the socket buffer says nothing about the link
+            self.throughput = self._ewma(self.throughput, nbytes / send_time)
+        frame_time = self.frame_time()
+        over = frame_time > self.frame_budget or (self.rtt is not None and self.rtt > self.latency_budget)
+        under = frame_time < 0.5 * self.frame_budget and (self.rtt is None or self.rtt < 0.5 * self.latency_budget)
+        self._over = self._over + 1 if over else 0
+        self._under = self._under + 1 if under else 0
+        if self._over >= self.down_after and self.level < len(self.ladder) - 1:
+            self.level += 1
+        elif self._under >= self.up_after and self.level > 0:
+            self.level -= 1
+        else:
+            return False
+        self._over = self._under = 0
+        return True
+
+    def report(self, timestamp):
+        current = self.current()
+        fps = 1.0 / self.frame_time() if self.frame_time() > 0 else 0.0
+        rtt_ms = self.rtt * 1e3 if self.rtt is not None else 0.0
+        mbps = self.throughput / 1e6 if self.throughput else 0.0
+        return QUALITY_REPORT.pack(timestamp, current["level"], current["codec"], current["bits"],
+                                   current["scale"], fps, rtt_ms, mbps)
+
+def unpack_report(data):
+    timestamp, level, codec, bits, scale, fps, rtt_ms, mbps = QUALITY_REPORT.unpack(data)
+    return {"timestamp": timestamp, "level": level, "codec": codec, "bits": bits, "scale": scale,
+            "fps": fps, "rtt_ms": rtt_ms, "mbps": mbps}
@@ -0,0 +1,293 @@
+#
+# Recording and replay of render streams.
+#
+#   remote_viewer = RemoteViewer(host, port, record="run.rvr") # every batch sent, with or without a viewer
+#   python start.py --replay run.rvr --speed 4                  # review it later
+#
+# A recording is two append-only files. run.rvr holds the image batches as
+# they go on the wire, each after the camera it was rendered with; frames are
+# always self-contained (no delta frames, no shared memory references).
+# run.rvr.idx holds one fixed-size entry per batch: where it is and when it was
+# sent. Replay memory-maps both, so seeking is a binary search in the index and
+# memory use does not grow with the length of the recording.
+#
+
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from collections import deque
+import numpy as np
+from protocol import BufferPool, CAMERA_MESSAGE, unpack_camera
+from RemoteRenderer import RendererStream
+
+RECORDING_MAGIC = b"RVREC001" # starts both files
+# index entry: record offset | record size | camera seq | camera timestamp | send time
+INDEX_ENTRY = struct.Struct("<QQQdd")
+_index_dtype = np.dtype([("offset", "<u8"), ("nbytes", "<u8"), ("camera_seq", "<u8"),
+                         ("camera_time", "<f8"), ("time", "<f8")])
+_no_camera = bytes(CAMERA_MESSAGE.size)
+
+class Recorder():
+    """Appends image batches to a recording, an existing one is continued.
+
+    submit() hands a batch to a writer thread, so encoding it for the recording
+    and writing it to disk stay off the send path. Only when max_pending batches
+    are waiting does it block: a recording never misses a batch.
+    """
+    def __init__(self, path, max_pending=32):
+        self.path = path
+        self._pending = queue.Queue(max_pending)
+        self._writer = None # started by the first submit()
+        index_path = path + ".idx"
+        if os.path.exists(index_path): # drop an entry torn by a crash, the ones after it would be misaligned
+            size = os.path.getsize(index_path)
+            torn = (size - len(RECORDING_MAGIC)) % INDEX_ENTRY.size if size >= len(RECORDING_MAGIC) else size
+            if torn:
+                os.truncate(index_path, size - torn)
+        self._data = open(path, "ab")
+        self._index = open(index_path, "ab")
+        for f in (self._data, self._index):
+            if f.tell() == 0:
+                f.write(RECORDING_MAGIC)
+        self.frames = (self._index.tell() - len(RECORDING_MAGIC)) // INDEX_ENTRY.size
+
+    def write(self, buffers, camera_message=None, camera_seq=0, camera_time=0.0, sent_time=None):
+        """buffers: one image batch as sent, head included. camera_message: the CAMERA_MESSAGE
+        bytes of the camera it was rendered with, None if unknown."""
+        offset = self._data.tell()
+        self._data.write(camera_message or _no_camera)
+        for buf in buffers:
+            self._data.write(buf)
+        self._data.flush() # the record is complete before its index entry, for a replay of a growing file
+        sent_time = time.time() if sent_time is None else sent_time
+        self._index.write(INDEX_ENTRY.pack(offset, self._data.tell() - offset, camera_seq, camera_time, sent_time))
+        self._index.flush()
+        self.frames += 1
+
+    def submit(self, encode, camera_message=None, camera_seq=0, camera_time=0.0, sent_time=None):
+        """Writes the buffers encode() returns on the writer thread, see write()."""
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+        sent_time = time.time() if sent_time is None else sent_time
+        self._pending.put((encode, camera_message, camera_seq, camera_time, sent_time))
+
+    def _write_loop(self):
+        while True:
+            job = self._pending.get()
+            if job is None: # closed
+                return
+            encode, *camera = job
+            try:
+                self.write(encode(), *camera)
+            except Exception as e:
+                print(f"recording {self.path}: {e}")
+
+    def close(self):
+        # after the batches still waiting are written
+        if self._writer is not None:
+            self._pending.put(None)
+            self._writer.join()
+        self._data.close()
+        self._index.close()
+
+class Recording():
+    """Read side of a recording, memory-mapped."""
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+        self.index = np.zeros(0, dtype=_index_dtype)
+        self.refresh()
+
+    def refresh(self):
+        """Maps what was written so far, a recording can be replayed while it grows.
+        Returns whether new records appeared."""
+        size = os.path.getsize(self.path + ".idx")
+        count = max(size - len(RECORDING_MAGIC), 0) // INDEX_ENTRY.size
+        if count == len(self.index):
+            return False
+        with open(self.path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+            raise ValueError(f"{self.path} is not a recording")
+        index = np.memmap(self.path + ".idx", dtype=_index_dtype, mode="r", offset=len(RECORDING_MAGIC), shape=(count,))
+        while count and int(index[count - 1]["offset"] + index[count - 1]["nbytes"]) > len(data):
+            count -= 1 # its record is still being written
+        self._data, self.index = data, index[:count]
+        return True
+
+    def __len__(self):
+        return len(self.index)
+
+    def duration(self):
+        return float(self.index["time"][-1] - self.index["time"][0]) if len(self.index) else 0.0
+
+    def time_of(self, frame):
+        # seconds since the first record
+        return float(self.index["time"][frame] - self.index["time"][0])
+
+    def frame_at(self, seconds):
+        """The last record sent at or before `seconds` into the recording."""
+        if not len(self.index):
+            return 0
+        frame = int(np.searchsorted(self.index["time"], self.index["time"][0] + seconds, "right")) - 1
+        return min(max(frame, 0), len(self.index) - 1)
+
+    def record(self, frame):
+        """(camera dict or None, memoryview of the batch as it went on the wire)"""
+        entry = self.index[frame]
+        offset, nbytes = int(entry["offset"]), int(entry["nbytes"])
+        view = memoryview(self._data)[offset:offset + nbytes]
+        camera = unpack_camera(view[:CAMERA_MESSAGE.size])
+        return (camera if camera["seq"] else None), view[CAMERA_MESSAGE.size:]
+
+class ReplaySource():
+    """Plays a recording back as if a renderer sent it: a drop-in for RemoteRenderer that
+    FrameReceiver reads, with the records parsed and decoded by a RendererStream.
+
+    Playback follows the send times of the recording times `speed`. When it falls
+    behind, frames are skipped rather than slowing down; pauses of the recorded run
+    longer than max_gap seconds are cut short.
+    """
+    def __init__(self, path, speed=1.0, loop=False, max_gap=2.0):
+        self.recording = Recording(path)
+        self.pool = BufferPool(max_per_size=8)
+        self.stream = RendererStream(0, None, ("replay", os.path.basename(path)), self.pool)
+        self.streams = {0: self.stream}
+        self.speed = speed
+        self.loop = loop
+        self.max_gap = max_gap
+        self.paused = False
+        self.position = 0 # next frame to show
+        self.frame = -1 # frame shown last
+        self._show_now = False # a seek shows its frame right away, even paused
+        self._messages = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._restart_clock(0.0)
+
+    def _restart_clock(self, play_time):
+        self._clock_start = play_time
+        self._wall_start = time.monotonic()
+
+    def play_time(self):
+        # seconds into the recording
+        if self.paused:
+            return self._clock_start
+        return self._clock_start + (time.monotonic() - self._wall_start) * self.speed
+
+    def _due(self):
+        # (frame to show now or None, seconds to wait before asking again or None)
+        if self.position >= len(self.recording):
+            self.recording.refresh()
+        count = len(self.recording)
+        if self._show_now and count:
+            return min(self.position, count - 1), 0.0
+        if self.paused or not count:
+            return None, None
+        if self.position >= count:
+            if not self.loop:
+                return None, 0.5 # a recording in progress may grow
+            self.position = 0
+            self._restart_clock(0.0)
+        now = self.play_time()
+        latest = self.recording.frame_at(now)
+        if latest >= self.position and self.recording.time_of(latest) <= now:
+            return latest, 0.0 # the frames before it are late, skip them
+        wait = self.recording.time_of(self.position) - now
+        if wait > self.max_gap:
+            self._restart_clock(self.recording.time_of(self.position))
+            return self.position, 0.0
+        return None, wait / self.speed
+
+    def _emit(self, frame):
+        camera, data = self.recording.record(frame)
+        self.stream.newest_answered = 0 # nothing in a replay is stale
+        self.stream.reader.feed_buffer(data)
+        for message in self.stream.messages:
+            if "batch" in message:
+                # our cameras did not render these, keep them away from reprojection and motion-to-photon
+                message["batch"].update(camera_seq=0, camera_time=0.0, camera=camera, frame=frame,
+                                        time=self.recording.time_of(frame))
+        self._messages.extend(self.stream.messages)
+        self.stream.messages.clear()
+
+    def read(self, timeout=None):
+        """Returns the next recorded message once it is due, {"status": 0} on timeout or wake()."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._messages:
+            with self._lock:
+                frame, wait = self._due()
+                if frame is not None:
+                    self._show_now = False
+                    self._wake.clear() # a seek's wake-up is answered by its frame
+                    self.frame, self.position = frame, frame + 1
+                    self._emit(frame)
+                    continue
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            if wait is None or (remaining is not None and remaining < wait):
+                wait = remaining
+            if self._wake.wait(wait):
+                self._wake.clear()
+                break
+        if self._messages:
+            return self._messages.popleft()
+        return {"status": 0}
+
+    def seek(self, seconds):
+        self.seek_frame(self.recording.frame_at(seconds))
+
+    def seek_frame(self, frame):
+        """Shows `frame` right away and plays on from there."""
+        with self._lock:
+            if not len(self.recording):
+                return
+            frame = min(max(frame, 0), len(self.recording) - 1)
+            self.position = frame
+            self._show_now = True
+            self._restart_clock(self.recording.time_of(frame))
+        self.wake()
+
+    def step(self, frames=1):
+        self.seek_frame(self.frame + frames)
+
+    def set_speed(self, speed):
+        with self._lock:
+            self._restart_clock(self.play_time())
+            self.speed = speed
+        self.wake()
+
+    def pause(self, paused=True):
+        with self._lock:
+            if paused != self.paused:
+                self._restart_clock(self.play_time())
+                self.paused = paused
+        self.wake()
+
+    # the rest of what the viewer uses of a RemoteRenderer
+    def stream_list(self):
+        return [self.stream]
+
+    def wake(self):
+        self._wake.set()
+
+    def resume_reading(self):
+        self.stream.can_read = True
+
+    def recycle(self, images):
+        for image in images:
+            self.pool.release_array(image)
+
+    def send_cameras(self, message_bytes, seq=0, stream_ids=None):
+        return [] # a recording has no renderer to move
+
+    def reset(self):
+        self.seek_frame(0)
+
+    def close(self):
+        self._messages.clear()
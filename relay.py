@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Relay: one renderer, any number of viewers.
+#
+#   python relay.py --port 12345 --viewers 10.0.0.2:12345,10.0.0.3:12345 --controller 0
+#
+# The renderer connects to the relay as it would to a viewer,
+# RemoteViewer("relay host", 12345), and the relay connects to every viewer as
+# the renderer would. Image batches are only parsed far enough to be forwarded:
+# their encoded bytes go to every viewer untouched, so a frame is compressed
+# once whatever the number of viewers. Every viewer has its own latest-frame-wins
+# slot, a slow one only drops its own frames. Only the controller's camera and
+# quality report echoes reach the renderer, the other viewers are told not to
+# send a camera; an adaptive renderer so follows the link to the controller.
+#
+
+import argparse
+import socket
+import threading
+import time
+from protocol import b2i, i2b, FRAME_HEADER, BATCH_HEADER, CAMERA_MESSAGE, WINDOW_SIZE, CAMERA_BATCH, VIEWPORT, \
+    FLAG_DELTA, parse_frame_header, send_buffers, IncrementalReader, take
+from shm_transport import SHM_OFFER
+from quality import QUALITY_REPORT, QUALITY_ECHO
+
+# renderer -> us: 1 image, 2 send cameras, 3 don't send cameras, 4 don't receive, 5 shm offer, 6 quality report
+# viewer -> us: 0 camera, 1 shm answer, 2 keyframe request, 3 quality report echo, 4 camera batch
+
+class Batch():
+    """The encoded buffers of one image batch, shared by every subscriber."""
+    def __init__(self, buffers, delta):
+        self.buffers = buffers
+        self.delta = delta # patches the previous frame, only valid for a viewer that got it
+
+class Subscriber():
+    """One viewer: connects out with backoff, sends on its own thread."""
+    def __init__(self, relay, host, port, controller=False):
+        self.relay = relay
+        self.host = host
+        self.port = port
+        self.controller = controller
+        self.connected = False
+        self.awaiting_keyframe = False
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self._control = [] # state and quality messages, never dropped
+        self.replayed_report = None # timestamp of the old quality report it got on connecting, its echo is no round trip
+        self._batch = None # newest batch not sent yet
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def post_control(self, message):
+        with self._cond:
+            if self.connected:
+                self._control.append(message)
+                self._cond.notify()
+
+    def await_keyframe(self):
+        with self._cond:
+            self.awaiting_keyframe = True
+
+    def post_batch(self, batch):
+        request_keyframe = False
+        with self._cond:
+            if not self.connected:
+                return
+            if batch.delta and (self.awaiting_keyframe or self._batch is not None):
+                # this delta is relative to a frame the viewer won't get, it would patch a stale canvas
+                self.frames_dropped += 1
+                request_keyframe = not self.awaiting_keyframe
+                self.awaiting_keyframe = True
+            else:
+                if self._batch is not None:
+                    self.frames_dropped += 1
+                self._batch = batch
+                if not batch.delta:
+                    self.awaiting_keyframe = False
+                self._cond.notify()
+        if request_keyframe: # outside the lock, the send upstream may block
+            self.relay.request_keyframe()
+
+    def _run(self):
+        backoff = 0.1
+        while not self.relay.closed:
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.relay.connect_timeout)
+            except OSError:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.relay.max_backoff)
+                continue
+            backoff = 0.1
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print(f"viewer {self.host}:{self.port} connected" + (" (controller)" if self.controller else ""))
+            with self._cond:
+                self.connected = True
+                self.awaiting_keyframe = False
+            self.relay.subscriber_connected(self)
+            reader = threading.Thread(target=self._read_loop, args=(sock,), daemon=True)
+            reader.start()
+            try:
+                self._send_loop(sock)
+            except OSError:
+                pass
+            with self._cond:
+                self.connected = False
+                self._control = []
+                self._batch = None
+            try:
+                sock.shutdown(socket.SHUT_RDWR) # unblocks the reader
+            except OSError:
+                pass
+            reader.join()
+            sock.close()
+            print(f"viewer {self.host}:{self.port} disconnected")
+
+    def _send_loop(self, sock):
+        while True:
+            with self._cond:
+                while self.connected and not self._control and self._batch is None:
+                    self._cond.wait()
+                if not self.connected:
+                    return
+                control, self._control = self._control, []
+                batch, self._batch = self._batch, None
+            buffers = [buf for message in control for buf in message]
+            if batch is not None:
+                buffers += batch.buffers
+            send_buffers(sock, buffers)
+            if batch is not None:
+                self.frames_sent += 1
+
+    def _read_loop(self, sock):
+        reader = IncrementalReader(self._parse())
+        try:
+            while reader.feed(sock):
+                pass
+        except (OSError, ConnectionError, ValueError):
+            pass
+        with self._cond:
+            self.connected = False
+            self._cond.notify()
+
+    def _parse(self):
+        while True:
+            head = b2i((yield from take(4)))
+            if head == 0:
+                message = yield from take(CAMERA_MESSAGE.size)
+                num_windows = CAMERA_MESSAGE.unpack(message)[-1]
+                window_sizes = yield from take(num_windows * WINDOW_SIZE.size)
+                if self.controller:
+                    self.relay.send_upstream([i2b(0), message, window_sizes])
+            elif head == 1:
+                yield from take(4) # we never offer shared memory
+            elif head == 2:
+                self.relay.request_keyframe()
+            elif head == 3:
+                echo = yield from take(QUALITY_ECHO.size)
+                if QUALITY_ECHO.unpack(echo)[0] == self.replayed_report:
+                    self.replayed_report = None
+                elif self.controller: # the renderer adapts to the link to the controller, relay included
+                    self.relay.send_upstream([i2b(3), echo])
+            elif head == 4:
+                batch = yield from take(CAMERA_BATCH.size)
+                buffers = [i2b(4), batch]
+                for _ in range(CAMERA_BATCH.unpack(batch)[1]):
+                    buffers.append((yield from take(VIEWPORT.size)))
+                    message = yield from take(CAMERA_MESSAGE.size)
+                    buffers += [message, (yield from take(CAMERA_MESSAGE.unpack(message)[-1] * WINDOW_SIZE.size))]
+                if self.controller:
+                    self.relay.send_upstream(buffers)
+            else:
+                raise ConnectionError(f"unknown message {head}")
+
+class Relay():
+    def __init__(self, viewers, controller=0, host="0.0.0.0", port=12345, connect_timeout=1.0, max_backoff=5.0,
+                 keyframe_interval=0.25):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.keyframe_interval = keyframe_interval # at most one keyframe request upstream per interval
+        self.closed = False
+        self.subscribers = [Subscriber(self, h, p, controller=(i == controller)) for i, (h, p) in enumerate(viewers)]
+        self._upstream = None
+        self._upstream_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._reset_state()
+
+    def _reset_state(self):
+        self.wants_camera = False
+        self.delta_seen = False
+        self.quality_report = None
+        self._last_keyframe_request = 0.0
+
+    def _state_messages(self, subscriber):
+        # what a viewer that just connected needs to hear first
+        wants_camera = self.wants_camera and subscriber.controller
+        messages = [[i2b(2 if wants_camera else 3)]]
+        if self.quality_report is not None:
+            subscriber.replayed_report = QUALITY_REPORT.unpack(self.quality_report)[0]
+            messages.append([i2b(6), self.quality_report])
+        return messages
+
+    def subscriber_connected(self, subscriber):
+        with self._state_lock:
+            for message in self._state_messages(subscriber):
+                subscriber.post_control(message)
+            needs_keyframe = self.delta_seen # it has no canvas yet
+            if needs_keyframe:
+                subscriber.await_keyframe()
+        if needs_keyframe:
+            self.request_keyframe(force=True)
+
+    def send_upstream(self, buffers):
+        with self._upstream_lock:
+            if self._upstream is None:
+                return
+            try:
+                send_buffers(self._upstream, buffers)
+            except OSError:
+                pass # the upstream reader notices and drops the renderer
+
+    def request_keyframe(self, force=False):
+        now = time.monotonic()
+        if force or now - self._last_keyframe_request > self.keyframe_interval:
+            self._last_keyframe_request = now
+            self.send_upstream([i2b(2)])
+
+    def _broadcast(self, message, controller_only=False):
+        for subscriber in self.subscribers:
+            if subscriber.controller or not controller_only:
+                subscriber.post_control(message)
+
+    def _parse_renderer(self):
+        while True:
+            head_bytes = yield from take(4)
+            head = b2i(head_bytes)
+            if head == 1:
+                batch_header = yield from take(BATCH_HEADER.size)
+                viewports = yield from take(BATCH_HEADER.unpack(batch_header)[-1] * VIEWPORT.size)
+                buffers, delta = [head_bytes, batch_header, viewports], False
+                for _ in range(BATCH_HEADER.unpack(batch_header)[0]):
+                    frame_header = yield from take(FRAME_HEADER.size)
+                    info = parse_frame_header(frame_header)
+                    delta |= bool(info["flags"] & FLAG_DELTA)
+                    buffers += [frame_header, (yield from take(info["payload_nbytes"]))]
+                if delta:
+                    self.delta_seen = True
+                batch = Batch(buffers, delta)
+                for subscriber in self.subscribers:
+                    subscriber.post_batch(batch)
+            elif head in (2, 3):
+                with self._state_lock:
+                    self.wants_camera = head == 2
+                    self._broadcast([i2b(head)], controller_only=head == 2)
+            elif head == 4:
+                self._broadcast([head_bytes])
+            elif head == 5:
+                yield from take(SHM_OFFER.size)
+                self.send_upstream([i2b(1), i2b(0)]) # the viewers are elsewhere, frames go over TCP
+            elif head == 6:
+                report = yield from take(QUALITY_REPORT.size)
+                if not any(s.controller and s.connected for s in self.subscribers):
+                    # nobody echoes it, the renderer still gets the round trip to us
+                    self.send_upstream([i2b(3), QUALITY_ECHO.pack(QUALITY_REPORT.unpack(report)[0])])
+                with self._state_lock:
+                    self.quality_report = bytes(report)
+                    self._broadcast([head_bytes, self.quality_report])
+            else:
+                raise ConnectionError(f"unknown message {head}")
+
+    def _read_upstream(self, conn):
+        reader = IncrementalReader(self._parse_renderer())
+        try:
+            while reader.feed(conn):
+                pass
+        except (OSError, ConnectionError, ValueError) as e:
+            print(e)
+        with self._upstream_lock:
+            if self._upstream is conn:
+                self._upstream = None
+        conn.close()
+        print("renderer disconnected")
+
+    def serve(self):
+        for subscriber in self.subscribers:
+            subscriber.start()
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.host, self.port))
+        server.listen()
+        print(f"relay listening on {self.host}:{self.port} for {len(self.subscribers)} viewers")
+        try:
+            while not self.closed:
+                conn, addr = server.accept()
+                print(f"renderer connected from {addr}")
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with self._upstream_lock:
+                    if self._upstream is not None: # a restarted run replaces the old one
+                        try:
+                            self._upstream.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass # it is gone already
+                    self._upstream = conn
+                with self._state_lock:
+                    self._reset_state()
+                threading.Thread(target=self._read_upstream, args=(conn,), daemon=True).start()
+        finally:
+            self.closed = True
+            server.close()
+
+def _address(text):
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+def main():
+    parser = argparse.ArgumentParser(description="forwards one renderer's stream to many viewers")
+    parser.add_argument("--host", default="0.0.0.0", help="address the renderer connects to")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--viewers", required=True, help="comma separated host:port of the viewers")
+    parser.add_argument("--controller", type=int, default=0, help="index of the viewer whose camera is used, -1: none")
+    args = parser.parse_args()
+    Relay([_address(v) for v in args.viewers.split(",")], args.controller, args.host, args.port).serve()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#
+# Client-side reprojection: warps the last frame of a window toward the
+# current camera while the frame rendered for it is still on its way, so a
+# camera drag moves the image right away instead of one round trip later.
+#
+# Pixels follow the matrices of the camera message: a camera space point X
+# (world_view @ world point) lands on ndc = (P[0,0] x / z, P[1,1] y / z), that is
+# pixel ((ndc + 1) / 2 * size), with P the projection of full_proj = P @ world_view.
+#
+# With a depth plane (view space z of every pixel, see send_images(depths=...))
+# the frame is forward splatted point by point with a z-buffer. Without one the
+# frame is taken as a plane facing its camera at `plane_depth`, the distance to
+# the orbit target, or at infinity (rotation only) when that is unknown too.
+# Both are plain vectorized NumPy, run by a Reprojector on a thread of its own
+# at reduced resolution so the GUI thread never waits for a warp.
+#
+
+import threading
+import numpy as np
+from profiling import timer
+
+def intrinsics(proj, width, height):
+    """Pixel matrix K of a projection matrix for an image of width x height."""
+    proj = np.asarray(proj, dtype=np.float64)
+    return np.array([[proj[0, 0] * width / 2, proj[0, 1] * width / 2, (proj[0, 2] + 1) * width / 2],
+                     [0.0, proj[1, 1] * height / 2, (proj[1, 2] + 1) * height / 2],
+                     [0.0, 0.0, 1.0]])
+
+def relative_pose(src_view, dst_view):
+    """(R, t) with X_src = R @ X_dst + t for camera space points of the two cameras."""
+    src_view = np.asarray(src_view, dtype=np.float64)
+    dst_view = np.asarray(dst_view, dtype=np.float64)
+    relative = src_view @ np.linalg.inv(dst_view)
+    return relative[:3, :3], relative[:3, 3]
+
+def plane_homography(K_src, K_dst, src_view, dst_view, plane_depth=None):
+    """Maps homogeneous destination pixels to source pixels for a plane z = plane_depth
+    in front of the source camera, None for the plane at infinity."""
+    R, t = relative_pose(src_view, dst_view)
+    # X_dst = R^T (X_src - t), and on the plane n.X_src / d = 1 with n = (0, 0, 1)
+    src_to_dst = R.T.copy()
+    if plane_depth:
+        src_to_dst -= np.outer(R.T @ t, [0.0, 0.0, 1.0 / plane_depth])
+    return np.linalg.inv(K_dst @ src_to_dst @ np.linalg.inv(K_src))
+
+def _pixel_grid(height, width):
+    v, u = np.mgrid[0:height, 0:width].astype(np.float64)
+    return np.stack([u + 0.5, v + 0.5, np.ones_like(u)]) # pixel centers, 3 x H x W
+
+def warp_homography(image, H, out_shape=None, fill=0):
+    """Nearest neighbour backward warp, out[p] = image[H p]."""
+    height, width = out_shape if out_shape is not None else image.shape[:2]
+    src = np.tensordot(H, _pixel_grid(height, width), axes=1)
+    w = src[2]
+    valid = w > 1e-9
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = np.floor(src[0] / w)
+        v = np.floor(src[1] / w)
+    valid &= (u >= 0) & (u < image.shape[1]) & (v >= 0) & (v < image.shape[0])
+    out = np.full((height, width) + image.shape[2:], fill, dtype=image.dtype)
+    out[valid] = image[v[valid].astype(np.intp), u[valid].astype(np.intp)]
+    return out
+
+def splat_depth(image, depth, K_src, K_dst, src_view, dst_view, out):
+    """Forward splats every pixel with a positive finite depth into `out`, the nearest one wins."""
+    height, width = image.shape[:2]
+    if depth.shape[:2] != (height, width):
+        raise ValueError(f"depth of shape {depth.shape} does not match the image {image.shape}")
+    depth = depth.reshape(-1)
+    source = np.flatnonzero(np.isfinite(depth) & (depth > 0)) # flat pixel indices, float32 from here on
+    pixels = np.stack([source % width + 0.5, source // width + 0.5, np.ones(len(source))]).astype(np.float32)
+    R, t = relative_pose(src_view, dst_view)
+    # source pixel -> source camera space -> destination pixel, as one matrix and one offset
+    to_dst = (K_dst @ R.T @ np.linalg.inv(K_src)).astype(np.float32)
+    offset = (K_dst @ R.T @ t).astype(np.float32)
+    projected = (to_dst @ pixels) * depth[source] - offset[:, None]
+    z = projected[2]
+    in_front = z > 1e-6
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = np.floor(projected[0] / z)
+        v = np.floor(projected[1] / z)
+    keep = np.flatnonzero(in_front & (u >= 0) & (u < out.shape[1]) & (v >= 0) & (v < out.shape[0]))
+    target = v[keep].astype(np.intp) * out.shape[1] + u[keep].astype(np.intp)
+    z = z[keep]
+    # z-buffer, a point is drawn where it is the nearest one landing on its pixel
+    zbuffer = np.full(out.shape[0] * out.shape[1], np.inf, dtype=np.float32)
+    np.minimum.at(zbuffer, target, z)
+    nearest = zbuffer[target] == z
+    colors = image.reshape((-1,) + image.shape[2:])[source[keep[nearest]]]
+    out.reshape((-1,) + out.shape[2:])[target[nearest]] = colors
+    return out
+
+def reproject(image, src_view, src_proj, dst_view, dst_proj, depth=None, plane_depth=None, fill=0):
+    """Warps `image`, rendered with the source camera, to how the destination camera would see it.
+    The result has the size of `image`. Pixels nothing maps to get the plane warp, or `fill`."""
+    height, width = image.shape[:2]
+    K_src = intrinsics(src_proj, width, height)
+    K_dst = intrinsics(dst_proj, width, height)
+    H = plane_homography(K_src, K_dst, src_view, dst_view, plane_depth)
+    out = warp_homography(image, H, fill=fill) # also fills the holes the splat leaves
+    if depth is not None:
+        splat_depth(image, depth, K_src, K_dst, src_view, dst_view, out)
+    return out
+
+class Reprojector():
+    """Warps frames on a background thread, only the newest request of each window is kept.
+
+    Frames larger than max_size are warped at every n-th pixel; the warp only bridges
+    the time until the frame rendered for the new camera arrives. The source image is
+    read while the warp runs: a caller that reuses it should cancel() first and drop
+    results tagged with the old frame.
+    """
+    def __init__(self, max_size=512, on_done=None):
+        self.max_size = max_size
+        self.on_done = on_done # called on the worker thread after every warp, e.g. to wake the GUI
+        self._jobs = {} # key -> arguments of the newest request
+        self._results = {} # key -> (tag, warped image)
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, key, tag, image, src_view, src_proj, dst_view, dst_proj, depth=None, plane_depth=None):
+        # tag comes back with the result, e.g. to tell which frame it was warped from
+        with self._cond:
+            self._jobs[key] = (tag, image, src_view, src_proj, dst_view, dst_proj, depth, plane_depth)
+            self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            self._jobs.pop(key, None)
+            self._results.pop(key, None)
+
+    def take_results(self):
+        """Returns {key: (tag, warped image)} of the warps finished since the last call."""
+        with self._cond:
+            results, self._results = self._results, {}
+        return results
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._jobs.clear()
+            self._cond.notify()
+        self._thread.join(1.0)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._jobs and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                key = next(iter(self._jobs))
+                tag, image, src_view, src_proj, dst_view, dst_proj, depth, plane_depth = self._jobs.pop(key)
+            step = max(-(-max(image.shape[:2]) // self.max_size), 1)
+            if step > 1:
+                image = image[::step, ::step]
+                depth = depth[::step, ::step] if depth is not None else None
+            with timer.stage("reproject"):
+                warped = reproject(image, src_view, src_proj, dst_view, dst_proj, depth=depth, plane_depth=plane_depth)
+            with self._cond:
+                self._results[key] = (tag, warped)
+            if self.on_done is not None:
+                self.on_done()
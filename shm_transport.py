@@ -0,0 +1,100 @@
+#
+# Same-host transport: frames are written into a shared memory ring and only
+# a small (slot, seq) reference goes over the socket.
+#
+# Layout of the segment: token (16 bytes) | slot 0 | slot 1 | ...
+# and of a slot:         seq (8 bytes)    | pixels
+# A slot's seq is cleared while the producer writes it and set afterwards,
+# so the reader can tell when the slot was overwritten during its copy.
+#
+
+import os
+import struct
+from multiprocessing import shared_memory
+
+TOKEN_BYTES = 16
+SLOT_HEADER = struct.Struct("<Q")
+# viewer side of the handshake: segment name, token, slots, slot size
+SHM_OFFER = struct.Struct("<64s16sIQ")
+# payload of a CODEC_SHM frame
+SHM_REF = struct.Struct("<IxxxxQ")
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # python >= 3.13
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # the creator owns the segment, don't let this process' resource tracker unlink it at exit
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+class ShmRing():
+    def __init__(self, shm, slots, slot_bytes, token, owner):
+        self.shm = shm
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.token = token
+        self.owner = owner
+        self.next_slot = 0
+        self.seq = 0
+
+    @classmethod
+    def create(cls, slots=8, slot_bytes=8 << 20):
+        size = TOKEN_BYTES + slots * (SLOT_HEADER.size + slot_bytes)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        token = os.urandom(TOKEN_BYTES)
+        shm.buf[:TOKEN_BYTES] = token
+        return cls(shm, slots, slot_bytes, token, owner=True)
+
+    @classmethod
+    def attach(cls, offer):
+        """Attaches to the ring described by an offer, returns None if it is not reachable from here."""
+        name, token, slots, slot_bytes = SHM_OFFER.unpack(offer)
+        try:
+            shm = _attach(name.rstrip(b"\0").decode())
+        except (OSError, ValueError):
+            return None # not on the same host
+        if bytes(shm.buf[:TOKEN_BYTES]) != token or shm.size < TOKEN_BYTES + slots * (SLOT_HEADER.size + slot_bytes):
+            shm.close()
+            return None
+        return cls(shm, slots, slot_bytes, token, owner=False)
+
+    def offer(self):
+        return SHM_OFFER.pack(self.shm.name.encode(), self.token, self.slots, self.slot_bytes)
+
+    def _slot(self, slot):
+        begin = TOKEN_BYTES + slot * (SLOT_HEADER.size + self.slot_bytes)
+        return begin, begin + SLOT_HEADER.size
+
+    def write(self, raw):
+        """Copies a contiguous buffer into the next slot, returns the SHM_REF payload
+        or None if it does not fit in a slot."""
+        raw = memoryview(raw).cast("B")
+        if raw.nbytes > self.slot_bytes:
+            return None
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.slots
+        self.seq += 1
+        header, data = self._slot(slot)
+        SLOT_HEADER.pack_into(self.shm.buf, header, 0)
+        self.shm.buf[data:data + raw.nbytes] = raw
+        SLOT_HEADER.pack_into(self.shm.buf, header, self.seq)
+        return SHM_REF.pack(slot, self.seq)
+
+    def read_into(self, ref, out):
+        """Copies the frame referenced by a SHM_REF payload into `out`.
+        Returns False if the producer already reused the slot."""
+        slot, seq = SHM_REF.unpack(ref)
+        if slot >= self.slots or len(out) > self.slot_bytes:
+            raise ValueError("bad shared memory frame reference")
+        header, data = self._slot(slot)
+        if SLOT_HEADER.unpack_from(self.shm.buf, header)[0] != seq:
+            return False
+        memoryview(out)[:] = self.shm.buf[data:data + len(out)]
+        return SLOT_HEADER.unpack_from(self.shm.buf, header)[0] == seq
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
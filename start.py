@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import argparse
 from interface import Interface
 if __name__ == "__main__":
-    interface = Interface()
+    parser = argparse.ArgumentParser(description="remote viewer, renderers connect to it")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--replay", help="play back a recording (RemoteViewer(..., record=path)) instead")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed")
+    args = parser.parse_args()
+    interface = Interface(host=args.host, port=args.port, replay=args.replay, speed=args.speed)
     interface.run()
-
-
-
-
-
-
@@ -0,0 +1,113 @@
+#
+# torch tensors as frames for RemoteViewer.send_images.
+#
+# A renderer's output (float CHW in [0, 1], usually on the GPU) is turned into
+# uint8 HWC on its own device, then copied with a non-blocking transfer into a
+# pinned host buffer reused from frame to frame. The copy is only waited for
+# right before encoding, on the sender thread in async mode, so the training
+# loop does not stall on it. Tensors on other accelerators (mps, xpu) are
+# copied synchronously. torch is never imported by this module: a frame can
+# only be a tensor if the caller already imported torch.
+#
+
+import sys
+import threading
+import numpy as np
+
+def is_tensor(image):
+    torch = sys.modules.get("torch")
+    return torch is not None and isinstance(image, torch.Tensor)
+
+def to_uint8_hwc(tensor):
+    """uint8 HWC (or HW) tensor on the tensor's device. Float images are taken as [0, 1]
+    and a 3-dim tensor whose first dimension looks like channels (<= 4) while the last
+    does not is taken as CHW."""
+    import torch
+    tensor = tensor.detach()
+    if tensor.dtype != torch.uint8:
+        if tensor.is_floating_point():
+            tensor = tensor.clamp(0, 1).mul_(255)
+        tensor = tensor.to(torch.uint8)
+    if tensor.ndim == 3 and tensor.shape[0] <= 4 < tensor.shape[-1]:
+        tensor = tensor.permute(1, 2, 0) # after the conversion, the copy is a quarter of the size
+    return tensor.contiguous()
+
+def to_depth_array(depth):
+    """float16 H x W numpy depth from an array or a tensor, half precision is plenty to reproject with.
+    Tensors are copied synchronously, depth is optional and small next to the images."""
+    if is_tensor(depth):
+        depth = depth.detach().cpu().numpy()
+    depth = np.squeeze(depth) # 1 x H x W or H x W x 1 as the renderer returns it
+    if depth.ndim != 2:
+        raise ValueError(f"a depth must be H x W, got shape {depth.shape}")
+    return depth.astype(np.float16) # also a copy, the caller may reuse its buffer
+
+class StagedBatch():
+    """Host copies of the tensors of one batch, maybe still in flight."""
+    def __init__(self, stager, buffers, events):
+        self.stager = stager
+        self.buffers = buffers
+        self.events = events
+
+    def wait(self):
+        for event in self.events:
+            event.synchronize()
+        self.events = []
+
+    def release(self):
+        # once the frames are encoded, the next batches copy into these buffers again
+        self.wait()
+        self.stager.release(self.buffers)
+        self.buffers = []
+
+class TensorStager():
+    def __init__(self, max_per_shape=4):
+        self.max_per_shape = max_per_shape
+        self._free = {} # shape -> [pinned uint8 tensor]
+        self._lock = threading.Lock() # released by the sender thread, acquired by the caller's
+
+    def _acquire(self, shape):
+        import torch
+        with self._lock:
+            free = self._free.get(shape)
+            if free:
+                return free.pop()
+        # pinned memory is a CUDA feature, other devices copy into plain host memory
+        return torch.empty(shape, dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+
+    def release(self, buffers):
+        with self._lock:
+            for buffer in buffers:
+                free = self._free.setdefault(tuple(buffer.shape), [])
+                if len(free) < self.max_per_shape:
+                    free.append(buffer)
+
+    def stage(self, images, copy):
+        """Returns numpy frames for `images` and the StagedBatch to wait on and release,
+        None if nothing was copied asynchronously. copy: the caller may overwrite its
+        arrays and CPU tensors once we return, keep our own copy of them."""
+        import torch
+        arrays, buffers, events = [], [], {}
+        for image in images:
+            if not is_tensor(image):
+                arrays.append(np.array(image) if copy else image)
+                continue
+            frame = to_uint8_hwc(image)
+            if frame.device.type == "cpu":
+                array = frame.numpy()
+                arrays.append(array.copy() if copy and frame.data_ptr() == image.data_ptr() else array)
+                continue
+            host = self._acquire(tuple(frame.shape))
+            buffers.append(host)
+            arrays.append(host.numpy())
+            if frame.device.type != "cuda": # no events to wait on elsewhere (mps, xpu), copy synchronously
+                host.copy_(frame)
+                continue
+            host.copy_(frame, non_blocking=True)
+            if frame.device not in events:
+                events[frame.device] = torch.cuda.Event()
+        for device, event in events.items():
+            event.record(torch.cuda.current_stream(device))
+        if not buffers:
+            return arrays, None
+        return arrays, StagedBatch(self, buffers, list(events.values()))
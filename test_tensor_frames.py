@@ -0,0 +1,51 @@
+#
+# The CPU path of torch tensor frames, run with: python -m pytest test_tensor_frames.py
+#
+
+import numpy as np
+import pytest
+torch = pytest.importorskip("torch")
+from tensor_frames import TensorStager, to_uint8_hwc, to_depth_array
+from RemoteViewer import RemoteViewer
+from RemoteRenderer import RemoteRenderer
+
+def _expected(tensor):
+    # what the viewer should show for a float CHW tensor in [0, 1]
+    return (tensor.clamp(0, 1) * 255).to(torch.uint8).permute(1, 2, 0).numpy()
+
+def test_float_chw_to_uint8_hwc():
+    tensor = torch.rand(3, 8, 16) * 1.2 - 0.1
+    frame = to_uint8_hwc(tensor)
+    assert frame.dtype == torch.uint8 and tuple(frame.shape) == (8, 16, 3)
+    assert np.array_equal(frame.numpy(), _expected(tensor))
+
+def test_stage_cpu_tensors():
+    tensor = torch.randint(0, 256, (8, 16, 3), dtype=torch.uint8)
+    arrays, staged = TensorStager().stage([tensor, np.zeros((2, 2), np.uint8)], copy=True)
+    assert staged is None # nothing to wait for on the CPU
+    assert np.array_equal(arrays[0], tensor.numpy())
+    tensor.zero_() # the caller reuses its tensor, the staged frame is a copy
+    assert arrays[0].any()
+
+def test_depth_tensor():
+    depth = to_depth_array(torch.full((1, 4, 5), 2.5))
+    assert depth.dtype == np.float16 and depth.shape == (4, 5) and (depth == 2.5).all()
+
+@pytest.mark.parametrize("async_send", [False, True])
+def test_send_cpu_tensors(async_send):
+    renderer = RemoteRenderer(host="127.0.0.1", port=0)
+    viewer = RemoteViewer("127.0.0.1", renderer.socker.getsockname()[1], codec="zlib", async_send=async_send)
+    try:
+        assert viewer.wait_for_viewer(5)
+        tensors = [torch.rand(3, 12, 20), torch.rand(4, 6, 10)]
+        viewer.send_images(tensors)
+        while True:
+            message = renderer.read(5)
+            assert message["status"] == 1 and not message.get("closed")
+            if "image" in message:
+                break
+        for image, tensor in zip(message["image"], tensors):
+            assert np.array_equal(image, _expected(tensor))
+    finally:
+        viewer.close()
+        renderer.close()
@@ -0,0 +1,81 @@
+import ctypes
+import numpy as np
+import OpenGL.GL as gl
+
+# channels -> (internal format, pixel format)
+_formats = {
+    1: (gl.GL_R8, gl.GL_RED),
+    3: (gl.GL_RGB8, gl.GL_RGB),
+    4: (gl.GL_RGBA8, gl.GL_RGBA),
+}
+
+def to_uint8(image):
+    # float images are taken as [0, 1], as renderers output them
+    if image.dtype == np.uint8:
+        return image
+    if np.issubdtype(image.dtype, np.floating):
+        return (np.clip(np.nan_to_num(image), 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+    raise ValueError(f"can not display an image of type {image.dtype}, send uint8 or floats in [0, 1]")
+
+class StreamingTexture():
+    """A texture whose content is replaced every frame.
+
+    Storage is allocated once per image size and updated with glTexSubImage2D.
+    Pixels go through a ring of pixel buffer objects: the copy into a mapped
+    PBO is a plain memcpy and the transfer to the texture runs asynchronously
+    on the GPU, while the next frame is written into the next PBO of the ring.
+    Each PBO is orphaned before mapping so we never wait for a pending transfer.
+    """
+    def __init__(self, num_pbos=3):
+        self.texture_id = gl.glGenTextures(1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_id)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
+        self.pbos = [int(pbo) for pbo in np.atleast_1d(gl.glGenBuffers(num_pbos))]
+        self.next_pbo = 0
+        self.shape = None # (height, width, channels) of the allocated storage
+
+    def _allocate(self, height, width, channels):
+        internal_format, pixel_format = _formats[channels]
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_id)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, internal_format, width, height, 0,
+                        pixel_format, gl.GL_UNSIGNED_BYTE, None)
+        # show single channel images as gray instead of red, the texture may have held one before
+        swizzle = [gl.GL_RED, gl.GL_RED, gl.GL_RED, gl.GL_ONE] if channels == 1 else \
+                  [gl.GL_RED, gl.GL_GREEN, gl.GL_BLUE, gl.GL_ALPHA]
+        gl.glTexParameteriv(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_SWIZZLE_RGBA, swizzle)
+        self.shape = (height, width, channels)
+
+    def upload(self, image):
+        if image.ndim not in (2, 3):
+            raise ValueError(f"can not display an image of shape {image.shape}")
+        if image.ndim == 2:
+            image = image[:, :, None]
+        image = np.ascontiguousarray(to_uint8(image))
+        height, width, channels = image.shape
+        if channels not in _formats:
+            raise ValueError(f"can not display an image with {channels} channels")
+        if self.shape != image.shape:
+            self._allocate(height, width, channels)
+        nbytes = image.nbytes
+        pbo = self.pbos[self.next_pbo]
+        self.next_pbo = (self.next_pbo + 1) % len(self.pbos)
+
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, pbo)
+        gl.glBufferData(gl.GL_PIXEL_UNPACK_BUFFER, nbytes, None, gl.GL_STREAM_DRAW) # orphan
+        ptr = gl.glMapBufferRange(gl.GL_PIXEL_UNPACK_BUFFER, 0, nbytes,
+                                  gl.GL_MAP_WRITE_BIT | gl.GL_MAP_INVALIDATE_BUFFER_BIT)
+        ctypes.memmove(ptr, image.ctypes.data, nbytes)
+        gl.glUnmapBuffer(gl.GL_PIXEL_UNPACK_BUFFER)
+
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_id)
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1) # rows of RGB images are not 4-byte aligned
+        gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, 0, 0, width, height, _formats[channels][1],
+                           gl.GL_UNSIGNED_BYTE, ctypes.c_void_p(0)) # offset into the bound PBO
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+
+    def delete(self):
+        gl.glDeleteBuffers(len(self.pbos), self.pbos)
+        gl.glDeleteTextures([self.texture_id])